@@ -0,0 +1,86 @@
+import argparse
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(output: str) -> List[Tuple[int, int, str]]:
+    # (self us, cumulative us, module) for every line of `-X importtime` output
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if self_us.strip().isdigit():  # Skips the header line
+            rows.append((int(self_us), int(cumulative_us), name.strip()))
+    return rows
+
+
+# `-X importtime` was added in 3.7, older interpreters only get the wall-clock time of the import
+WALL_CLOCK = "import time; started = time.perf_counter(); import {0}; print(int((time.perf_counter() - started) * 1e6))"
+
+
+def has_importtime(python: str = sys.executable) -> bool:
+    # Asks the interpreter that runs the import, which need not be this one
+    if python == sys.executable:
+        return sys.version_info >= (3, 7)
+    proc = subprocess.run([python, "-c", "import sys; print(sys.version_info >= (3, 7))"],
+                          stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return proc.stdout.strip() == "True"
+
+
+def measure(module: str, python: str = sys.executable,
+            importtime: bool = None) -> Tuple[int, List[Tuple[int, int, str]], str]:
+    # Imports the module in a fresh interpreter, returns its cumulative import time in us
+    if importtime is None:
+        importtime = has_importtime(python)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    if not importtime:
+        proc = subprocess.run([python, "-c", WALL_CLOCK.format(module)],
+                              env=env, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        return int(proc.stdout), [], proc.stdout
+
+    proc = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"],
+                          env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    rows = parse_importtime(proc.stderr)
+    cumulative = next(cumulative for _, cumulative, name in rows if name == module)
+    return cumulative, rows, proc.stderr
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Check the cold import time of a module against a budget")
+    arg_parser.add_argument("module", nargs="?", default="bytepatches.decorators")
+    arg_parser.add_argument("-b", "--budget", type=float, default=100.0, help="median budget in ms")
+    # 3.6 imports the same modules more slowly (about 105 ms against 65 ms wall-clock on 3.7)
+    arg_parser.add_argument("--wall-clock-budget", type=float, default=150.0,
+                            help="median budget in ms for interpreters without -X importtime")
+    arg_parser.add_argument("-n", "--runs", type=int, default=7)
+    arg_parser.add_argument("-o", "--output",
+                            help="file to write the median run's -X importtime (or wall-clock) output to")
+    arg_parser.add_argument("-p", "--python", default=sys.executable, help="interpreter to import the module with")
+    arg_parser.add_argument("--top", type=int, default=10, help="slowest modules to show")
+    args = arg_parser.parse_args()
+
+    importtime = has_importtime(args.python)
+    budget = args.budget
+    if not importtime:
+        print("-X importtime needs Python 3.7+, timing the whole import instead", file=sys.stderr)
+        budget = args.wall_clock_budget
+
+    runs = sorted((measure(args.module, args.python, importtime) for _ in range(args.runs)), key=lambda run: run[0])
+    cumulative, rows, raw = runs[len(runs) // 2]
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(raw)
+
+    print(f"{args.module}: median {cumulative / 1000:.1f} ms over {args.runs} runs "
+          f"(min {runs[0][0] / 1000:.1f} ms, max {runs[-1][0] / 1000:.1f} ms, budget {budget:.1f} ms)")
+    for self_us, _, name in sorted(rows, reverse=True)[:args.top]:
+        print(f"  {self_us / 1000:8.2f} ms  {name}")
+
+    if cumulative / 1000 > budget:
+        print("Over budget", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,167 @@
+import argparse
+import dis
+import json
+import os
+import platform
+import py_compile
+import sys
+import tempfile
+import time
+from types import CodeType, FunctionType
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bytepatches.decorators import optimize  # noqa: E402
+from bytepatches.op_replacer import change_ops, optimize_access  # noqa: E402
+from bytepatches.ops import LOAD_FAST, LOAD_CONST, BINARY_ADD, BINARY_SUBTRACT  # noqa: E402
+from bytepatches.parser import Parser, DECODERS, iter_instructions  # noqa: E402
+from bytepatches.pyc_parser import PycParser  # noqa: E402
+from bytepatches.utils import make_bytecode  # noqa: E402
+
+SIZES = (10, 100, 1000, 10000, 100000)
+LOCALS = 300  # Past 256, so slots need EXTENDED_ARG
+
+# Statement templates using only opcodes the parser handles, roughly 10 instructions each.
+# Calls always take exactly one argument, the tree decoder assumes that.
+STATEMENTS = (
+    "    x{a} = x{b} + {c}\n",
+    "    x{a} = x{b} * {c} - x{a}\n",
+    "    if x{b} > {c}:\n        x{a} = x{b} - {c}\n    else:\n        x{a} = x{c} + 1\n",
+    "    for i in range({c}):\n        x{a} = x{a} + i\n        if i > x{b}:\n            break\n",
+    "    while x{a} < {c}:\n        x{a} = x{a} + 1\n",
+    "    x{a} = x{b} or {c}\n",
+    "    def f{a}(p):\n        q = p + {c}\n        return q\n    x{a} = f{a}(x{b})\n",
+    "    x{a} = str(x{b}).upper()\n",
+)
+
+
+def generate_source(instructions: int, name: str = "generated") -> str:
+    # A function with about `instructions` instructions, plenty of jumps, loops and nested code objects
+    lines = [f"def {name}(x0):\n"]
+    lines += [f"    x{i} = {i}\n" for i in range(1, min(LOCALS, instructions // 4 + 2))]
+    count = 4 * len(lines)
+    index = 0
+    while count < instructions or index == 0:
+        template = STATEMENTS[index % len(STATEMENTS)]
+        a = 1 + index % (len(lines) - 1)
+        lines.append(template.format(a=a, b=1 + (index * 7) % (len(lines) - 1), c=index % 97 + 2))
+        count += 10
+        index += 1
+    lines.append("    return x1\n")
+    return "".join(lines)
+
+
+def count_instructions(code: CodeType) -> int:
+    return sum(1 for _ in iter_instructions(code.co_code))
+
+
+def check_supported(code: CodeType):
+    for instruction in dis.get_instructions(code):
+        if instruction.opcode not in DECODERS and instruction.opname != "EXTENDED_ARG":
+            raise ValueError(f"Generated code uses unsupported {instruction.opname}")
+        if isinstance(instruction.argval, CodeType):
+            check_supported(instruction.argval)
+
+
+def timeit(func: Callable[[], None], setup: Callable[[], None] = None, repeat: int = 5, budget: float = 1.0) -> Dict:
+    # Best and mean of `repeat` runs, fewer when a single run already takes longer than the budget
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+        if sum(times) > budget * repeat:
+            break
+    return {"best": min(times), "mean": sum(times) / len(times), "runs": len(times)}
+
+
+def bench_size(instructions: int, repeat: int, workdir: str) -> List[Dict]:
+    source = generate_source(instructions)
+    module = compile(source, "<generated>", "exec")
+    namespace = {}
+    exec(module, namespace)
+    func = namespace["generated"]
+    code = func.__code__
+    check_supported(code)
+
+    path = os.path.join(workdir, f"generated_{instructions}.py")
+    with open(path, "w") as f:
+        f.write(source)
+    pyc = py_compile.compile(path, cfile=path + "c")
+
+    state = {}
+
+    def parse_flat():
+        state["ops"] = Parser(code).parse_bytecode(False)
+
+    pattern_before = [LOAD_FAST("$1"), LOAD_CONST("$2"), BINARY_ADD(0)]
+    pattern_after = [LOAD_FAST("$1"), LOAD_CONST("$2"), BINARY_SUBTRACT(0)]
+
+    def optimize_fresh():
+        optimize(FunctionType(code, namespace))
+
+    def pyc_load():
+        with PycParser(pyc) as parser:
+            parser.parse()
+            parser.code
+
+    def parse_nested(code: CodeType):
+        for const in code.co_consts:
+            if isinstance(const, CodeType):
+                Parser(const).parse_bytecode(True)
+                parse_nested(const)
+
+    def pyc_parse():
+        # Loading plus the Parser pass over the module's ops and every function in it
+        with PycParser(pyc) as parser:
+            parser.content
+            parse_nested(parser.code)
+
+    stages = {
+        "parse_flat": (parse_flat, None),
+        "parse_tree": (lambda: Parser(code).parse_bytecode(True), None),
+        "change_ops": (lambda: change_ops(state["ops"], pattern_before, pattern_after), parse_flat),
+        "optimize_access": (lambda: optimize_access(state["ops"], code), parse_flat),
+        "optimize": (optimize_fresh, None),
+        "make_bytecode": (lambda: make_bytecode(state["ops"]), parse_flat),
+        "pyc_load": (pyc_load, None),
+        "pyc_parse": (pyc_parse, None),
+    }
+
+    total = count_instructions(code)
+    results = []
+    for stage, (func, setup) in stages.items():
+        result = {"size": instructions, "instructions": total, "stage": stage}
+        result.update(timeit(func, setup, repeat))
+        result["per_instruction_ns"] = result["best"] / total * 1e9
+        results.append(result)
+        print(f"{instructions:>7} {stage:<16} {result['best'] * 1000:10.3f} ms  "
+              f"{result['per_instruction_ns']:8.1f} ns/instr", file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Time each bytepatches stage on generated functions")
+    arg_parser.add_argument("-s", "--sizes", type=int, nargs="+", default=SIZES, help="instructions per function")
+    arg_parser.add_argument("-r", "--repeat", type=int, default=5)
+    arg_parser.add_argument("-o", "--output", default="-", help="JSON file to write, - for stdout")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = [result for size in args.sizes for result in bench_size(size, args.repeat, workdir)]
+
+    report = {
+        "python": sys.version,
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
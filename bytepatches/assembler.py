@@ -0,0 +1,101 @@
+from types import CodeType
+from typing import Dict, List, Tuple
+
+from bytepatches import stats
+from bytepatches.cfg import Block, CFG
+from bytepatches.ops import Opcode, JumpOp, FOR_ITER, JUMP_IF_TRUE_OR_POP
+from bytepatches.utils import build_code, make_bytecode
+
+# dis.stack_effect() only knows the larger of the two before 3.8: (falling through, jumping)
+BRANCH_EFFECTS = {
+    FOR_ITER: (1, -1),  # The iterator is popped once it is exhausted
+    JUMP_IF_TRUE_OR_POP: (-1, 0),
+}
+
+
+def branch_effects(op: Opcode) -> Tuple[int, int]:
+    if type(op) in BRANCH_EFFECTS:
+        return BRANCH_EFFECTS[type(op)]
+    effect = op.stack_effect()
+    return effect, effect
+
+
+def check_depth(op: Opcode, depth: int):
+    # Running such code would read past the bottom of the value stack and crash the interpreter
+    if depth < 0:
+        raise ValueError(f"{op.op_name} at offset {op.bytecode_pos} pops more values than the stack holds")
+
+
+def stack_depth(ops: List[Opcode]) -> int:
+    # The deepest the value stack gets on any path through the reachable blocks.
+    # BREAK_LOOP has no edge of its own, the loop's exit is reached at the SETUP_LOOP's depth through its target.
+    started = stats.start()
+    cfg = CFG(ops)
+    depths: Dict[Block, int] = {cfg.entry: 0}
+    worklist = [cfg.entry]
+    deepest = 0
+
+    while worklist:
+        block = worklist.pop()
+        depth = depths[block]
+        for op in block.ops[:-1]:
+            depth += op.stack_effect()
+            check_depth(op, depth)
+            deepest = max(deepest, depth)
+
+        last = block.last
+        falling, jumping = branch_effects(last)
+        check_depth(last, depth + min(falling, jumping))
+        edges = []
+        if isinstance(last, JumpOp) and last.val is not None:
+            edges.append((cfg.block_of(last.val), depth + jumping))
+        following = cfg.next_block(block)
+        if block.falls_through() and following is not None:
+            edges.append((following, depth + falling))
+
+        for successor, entry in edges:
+            deepest = max(deepest, entry)
+            if depths.get(successor, -1) < entry:
+                depths[successor] = entry
+                worklist.append(successor)
+
+    stats.stop(started, "stack", len(ops))
+    return deepest
+
+
+def line_table(ops: List[Opcode], firstlineno: int) -> bytes:
+    # co_lnotab from the lines the ops were parsed from, ops without one continue the line before them
+    table = bytearray()
+    line = firstlineno
+    offset = start = 0
+    for op in ops:
+        if op.lineno is not None and op.lineno != line:
+            address = offset - start
+            delta = op.lineno - line
+            while address > 255:
+                table += bytes((255, 0))
+                address -= 255
+            while delta > 127:
+                table += bytes((address, 127))
+                address = 0
+                delta -= 127
+            while delta < -128:
+                table += bytes((address, -128 & 0xFF))
+                address = 0
+                delta += 128
+            table += bytes((address, delta & 0xFF))
+            line = op.lineno
+            start = offset
+        offset += op.size()
+    return bytes(table)
+
+
+def assemble(fn_code: CodeType, ops: List[Opcode], consts=None, names=None, varnames=None) -> CodeType:
+    # Builds the code object for `ops` in one go, with co_stacksize and co_lnotab recomputed
+    ops = [op for op in ops if op is not None]
+    payload = make_bytecode(ops)
+    if (payload == fn_code.co_code and (consts is None or consts is fn_code.co_consts) and
+            (names is None or names is fn_code.co_names) and (varnames is None or varnames is fn_code.co_varnames)):
+        return fn_code  # Unchanged, and the compiler's own metadata is already right
+    return build_code(fn_code, payload, consts, names, varnames,
+                      stacksize=stack_depth(ops), lnotab=line_table(ops, fn_code.co_firstlineno))
@@ -0,0 +1,82 @@
+import builtins
+from typing import Any, Dict, Iterable, Optional
+
+from bytepatches.assembler import assemble
+from bytepatches.op_replacer import optimize_access
+from bytepatches.ops import LOAD_GLOBAL, LOAD_CONST
+from bytepatches.parser import Parser
+from bytepatches.utils import patch_function
+
+BOUND_ATTRIBUTE = "__bound_globals__"  # name -> index in co_consts, set on bound functions
+
+_MISSING = object()
+
+
+def resolve_global(func, name: str) -> Any:
+    # What LOAD_GLOBAL would find right now: the function's globals, then its builtins
+    if name in func.__globals__:
+        return func.__globals__[name]
+    scope = func.__globals__.get("__builtins__", builtins)
+    if not isinstance(scope, dict):
+        scope = vars(scope)
+    return scope.get(name, _MISSING)
+
+
+def _bind(func, only: Optional[Iterable[str]], exclude: Iterable[str]):
+    only = None if only is None else set(only)
+    exclude = set(exclude)
+    fn_code = func.__code__
+    bound: Dict[str, int] = dict(getattr(func, BOUND_ATTRIBUTE, {}))
+    consts = list(fn_code.co_consts)
+
+    ops = Parser(func).parse_bytecode(False)
+    for index, op in enumerate(ops):
+        if not isinstance(op, LOAD_GLOBAL):
+            continue
+        name = op.arg
+        if name in exclude or (only is not None and name not in only):
+            continue
+        if name not in bound:
+            value = resolve_global(func, name)
+            if value is _MISSING:
+                continue  # Still raises NameError when it runs
+            # A slot of its own per name, so rebinding never touches other constants
+            bound[name] = len(consts)
+            consts.append(value)
+        ops[index] = LOAD_CONST(bound[name], consts[bound[name]])
+        ops[index].set_bytecode_pos(op.bytecode_pos)
+        ops[index].lineno = op.lineno
+
+    if len(consts) == len(fn_code.co_consts):
+        return func
+    names, varnames = optimize_access(ops, fn_code)
+    func.__code__ = assemble(fn_code, ops, consts=tuple(consts), names=names, varnames=varnames)
+    setattr(func, BOUND_ATTRIBUTE, bound)
+    return func
+
+
+def bind_globals(func=None, *, only: Iterable[str] = None, exclude: Iterable[str] = ()):
+    # Turns LOAD_GLOBALs into LOAD_CONSTs of the values the names have now.
+    # Use as @bind_globals, or @bind_globals(only=[...]) / @bind_globals(exclude=[...]).
+    if func is None:
+        return lambda func: _bind(func, only, exclude)
+    return _bind(func, only, exclude)
+
+
+def rebind_globals(func, *names: str, **values):
+    # Updates bound constants, from keyword arguments or else from the current globals.
+    # Without names, every bound global is looked up again.
+    bound: Dict[str, int] = getattr(func, BOUND_ATTRIBUTE, {})
+    names = set(names or bound) | set(values)
+    unknown = names - set(bound)
+    if unknown:
+        raise KeyError(f"Not bound in {func.__name__}: {', '.join(sorted(unknown))}")
+
+    consts = list(func.__code__.co_consts)
+    for name in names:
+        value = values[name] if name in values else resolve_global(func, name)
+        if value is _MISSING:
+            raise NameError(f"name '{name}' is not defined")
+        consts[bound[name]] = value
+    patch_function(func, func.__code__.co_code, consts=tuple(consts))
+    return func
@@ -0,0 +1,84 @@
+import argparse
+import dis
+import json
+import os
+from collections import Counter
+from multiprocessing import Pool
+from types import CodeType
+from typing import Iterable, Iterator, List, Optional
+
+from bytepatches.parser import DECODERS, iter_instructions
+from bytepatches.pyc_parser import PycParser
+
+
+def find_pyc(root: str) -> Iterator[str]:
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(".pyc"):
+                yield os.path.join(dirpath, filename)
+
+
+def code_tree(code: CodeType, counts: Counter, errors: List[str]) -> dict:
+    # Also collects the opcodes bytepatches can't parse yet, the first one per code object
+    instructions = 0
+    unhandled = None
+    for pos, opcode, arg in iter_instructions(code.co_code):
+        counts[dis.opname[opcode]] += 1
+        instructions += 1
+        if unhandled is None and opcode not in DECODERS:
+            unhandled = (f"UnhandledOpcode: Unhandled opcode {dis.opname[opcode]} ({opcode}) with argument {arg} "
+                         f"at offset {pos} in {code.co_name}")
+            errors.append(unhandled)
+    return {
+        "name": code.co_name,
+        "firstlineno": code.co_firstlineno,
+        "instructions": instructions,
+        "children": [code_tree(const, counts, errors) for const in code.co_consts if isinstance(const, CodeType)],
+    }
+
+
+def summarize(path: str) -> dict:
+    # Only builtin types, so summaries can be sent back from the pool and marshalled as-is
+    summary = {"path": path, "header": None, "code": None, "opcodes": None, "error": None}
+    try:
+        with PycParser(path, use_mmap=True) as parser:
+            parser.parse_header()
+            summary["header"] = {
+                "version": parser.version,
+                "flags": parser.flags,
+                "timestamp": None if parser.timestamp is None else int(parser.timestamp.timestamp()),
+                "size": parser.size,
+                "source_hash": parser.source_hash,
+            }
+            counts = Counter()
+            errors = []
+            summary["code"] = code_tree(parser.code, counts, errors)
+            summary["opcodes"] = dict(counts)
+            if errors:
+                summary["error"] = errors[0]
+    except Exception as e:
+        summary["error"] = f"{type(e).__name__}: {e}"
+    return summary
+
+
+def analyze(paths: Iterable[str], workers: Optional[int] = None, chunksize: int = 16) -> Iterator[dict]:
+    # Summaries are yielded as soon as workers finish them, not in the order of `paths`
+    with Pool(workers) as pool:
+        yield from pool.imap_unordered(summarize, paths, chunksize)
+
+
+def analyze_tree(root: str, workers: Optional[int] = None, chunksize: int = 16) -> Iterator[dict]:
+    return analyze(find_pyc(root), workers, chunksize)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Summarize every .pyc file in a directory tree")
+    arg_parser.add_argument("root")
+    arg_parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    arg_parser.add_argument("-c", "--chunksize", type=int, default=16, help="files sent to a worker at once")
+    args = arg_parser.parse_args()
+
+    for result in analyze_tree(args.root, args.workers, args.chunksize):
+        if result["header"] and result["header"]["source_hash"] is not None:
+            result["header"]["source_hash"] = result["header"]["source_hash"].hex()
+        print(json.dumps(result))
@@ -0,0 +1,199 @@
+import hashlib
+import marshal
+import os
+from importlib.util import MAGIC_NUMBER
+from types import CodeType
+from typing import Any, Optional
+
+from bytepatches import __version__
+
+SUFFIX = ".code"
+
+# Everything that makes up a code object, so a hit also has the right filename and line numbers
+CODE_FIELDS = ("co_argcount", "co_kwonlyargcount", "co_nlocals", "co_stacksize", "co_flags", "co_code", "co_consts",
+               "co_names", "co_varnames", "co_freevars", "co_cellvars", "co_filename", "co_name", "co_firstlineno",
+               "co_lnotab")
+SCALARS = (type(None), type(Ellipsis), bool, int, float, complex, str, bytes)
+
+
+_sources_digest: Optional[str] = None
+
+
+def sources_digest() -> str:
+    # Digest of bytepatches' own sources. Patch fingerprints include it, so a change to any pass
+    # invalidates what the previous code patched, without anyone having to bump __version__.
+    global _sources_digest
+    if _sources_digest is None:
+        digest = hashlib.sha256(__version__.encode())
+        package = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package)):
+            if name.endswith(".py"):
+                digest.update(name.encode())
+                with open(os.path.join(package, name), "rb") as f:
+                    digest.update(f.read())
+        _sources_digest = digest.hexdigest()
+    return _sources_digest
+
+
+def canonical(value) -> Any:
+    # A form of a code object or constant that is the same in every process.
+    # marshal.dumps() isn't, it writes back-references depending on which objects happen to be shared.
+    if isinstance(value, CodeType):
+        return "code", tuple(canonical(getattr(value, field)) for field in CODE_FIELDS)
+    if isinstance(value, tuple):
+        return "tuple", tuple(canonical(item) for item in value)
+    if isinstance(value, frozenset):
+        return "frozenset", tuple(sorted(repr(canonical(item)) for item in value))
+    if isinstance(value, SCALARS):
+        return type(value).__name__, repr(value)  # Keeps 1, 1.0 and True as well as 0.0 and -0.0 apart
+    raise ValueError(f"Cannot cache {type(value).__name__} constants")
+
+
+class CodeCache:
+    # Patched code objects on disk, one marshalled file per (original code, patch fingerprint).
+    # Entries are written atomically, unreadable ones are deleted and the least recently used are evicted
+    # once the directory grows past max_size bytes.
+
+    def __init__(self, directory: str, max_size: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"CodeCache({self.directory!r}, hits={self.hits}, misses={self.misses}, max_size={self.max_size})"
+
+    @staticmethod
+    def key(code: CodeType, fingerprint: str) -> Optional[str]:
+        # None for code holding constants that can't be stored, such as functions bound by bind_globals
+        try:
+            data = repr(canonical(code)).encode()
+        except ValueError:
+            return None
+        digest = hashlib.sha256()
+        digest.update(MAGIC_NUMBER)
+        digest.update(fingerprint.encode())
+        digest.update(data)
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, code: CodeType, fingerprint: str) -> Optional[CodeType]:
+        key = self.key(code, fingerprint)
+        if key is None:
+            return None
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        try:
+            patched = marshal.loads(data)
+            if not isinstance(patched, CodeType):
+                raise ValueError("not a code object")
+        except (EOFError, ValueError, TypeError):
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return patched
+
+    def put(self, code: CodeType, fingerprint: str, patched: CodeType):
+        import tempfile  # Only needed on a miss, and slow to import
+        key = self.key(code, fingerprint)
+        try:
+            data = marshal.dumps(patched)
+        except ValueError:
+            return  # Holds constants marshal can't store
+        if key is None:
+            return
+        path = self.path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            self._remove(tmp)
+            return
+
+        if self._size is not None:
+            self._size += len(data)
+        if self.size() > self.max_size:
+            self.evict()
+
+    def entries(self):
+        # (mtime, size, path) of every entry
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                result.append((stat.st_mtime, stat.st_size, path))
+        return result
+
+    def size(self) -> int:
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self.entries())
+        return self._size
+
+    def evict(self):
+        # Oldest entries go first, until the cache is back to 3/4 of its size
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_size * 3 // 4
+        for _, size, path in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+        self._size = total
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self._remove(path)
+        self._size = 0
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_cache: Optional[CodeCache] = None
+
+
+def default_directory() -> str:
+    return os.environ.get("BYTEPATCHES_CACHE") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "bytepatches")
+
+
+def enable_cache(directory: str = None, max_size: int = 64 * 1024 * 1024) -> CodeCache:
+    global _cache
+    _cache = CodeCache(directory or default_directory(), max_size)
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+def get_cache() -> Optional[CodeCache]:
+    return _cache
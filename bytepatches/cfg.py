@@ -0,0 +1,381 @@
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from bytepatches.ops import Opcode, JumpOp, JUMP_FORWARD, JUMP_ABSOLUTE, SETUP_LOOP, BREAK_LOOP, RETURN_VALUE, \
+    LOAD_FAST, STORE_FAST, sync_ops, retarget
+
+# Jumps that never fall through, every other jump also continues at the next op
+UNCONDITIONAL = (JUMP_FORWARD, JUMP_ABSOLUTE)
+# Ops that end a block without a jump target of their own
+TERMINATORS = (RETURN_VALUE, BREAK_LOOP)
+
+
+class Block:
+    __slots__ = ("ops", "successors", "predecessors", "_uses", "_defs")
+
+    def __init__(self, ops: List[Opcode]):
+        self.ops = ops
+        self.successors: List['Block'] = []
+        self.predecessors: List['Block'] = []
+        self._uses: Optional[FrozenSet[str]] = None
+        self._defs: Optional[FrozenSet[str]] = None
+
+    def __repr__(self):
+        return f"Block({self.ops[0].op_name}..{self.ops[-1].op_name}, {len(self.ops)} ops)"
+
+    @property
+    def first(self) -> Opcode:
+        return self.ops[0]
+
+    @property
+    def last(self) -> Opcode:
+        return self.ops[-1]
+
+    def falls_through(self) -> bool:
+        return not isinstance(self.last, UNCONDITIONAL + TERMINATORS)
+
+    def uses_defs(self) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        # Locals read before they are written in this block, and locals written in it
+        if self._uses is None:
+            uses = set()
+            defs = set()
+            for op in self.ops:
+                if isinstance(op, LOAD_FAST) and op.arg not in defs:
+                    uses.add(op.arg)
+                elif isinstance(op, STORE_FAST):
+                    defs.add(op.arg)
+            self._uses = frozenset(uses)
+            self._defs = frozenset(defs)
+        return self._uses, self._defs
+
+
+class Loop:
+    __slots__ = ("header", "blocks", "parent", "children")
+
+    def __init__(self, header: Block, blocks: Set[Block]):
+        self.header = header
+        self.blocks = blocks
+        self.parent: Optional['Loop'] = None
+        self.children: List['Loop'] = []
+
+    def __repr__(self):
+        return f"Loop({self.header}, {len(self.blocks)} blocks, depth={self.depth})"
+
+    @property
+    def depth(self) -> int:
+        depth = 1
+        loop = self.parent
+        while loop is not None:
+            depth += 1
+            loop = loop.parent
+        return depth
+
+
+class CFG:
+    # Basic blocks of a flat op list, linked through the targets sync_ops resolved.
+    # Edits go through replace()/remove(), which keep edges up to date and only drop the analyses they affect;
+    # linearize() writes the blocks back to an op list.
+
+    def __init__(self, ops: List[Opcode]):
+        self.blocks: List[Block] = []
+        self._block_of: Dict[int, Block] = {}
+        self._positions: Dict[Block, int] = {}
+        self._reachable: Optional[Set[Block]] = None
+        self._idom: Optional[Dict[Block, Block]] = None
+        self._loops: Optional[List[Loop]] = None
+        self._live_in: Optional[Dict[Block, FrozenSet[str]]] = None
+        self._live_out: Optional[Dict[Block, FrozenSet[str]]] = None
+        self.build(ops)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __repr__(self):
+        return f"CFG({len(self.blocks)} blocks)"
+
+    @property
+    def entry(self) -> Block:
+        return self.blocks[0]
+
+    def build(self, ops: List[Opcode]):
+        ops = [op for op in ops if op is not None]
+        targets = {id(op.val) for op in ops if isinstance(op, JumpOp) and op.val is not None}
+
+        self.blocks = []
+        current = []
+        for op in ops:
+            if current and id(op) in targets:
+                self.blocks.append(Block(current))
+                current = []
+            current.append(op)
+            if isinstance(op, (JumpOp,) + TERMINATORS):
+                self.blocks.append(Block(current))
+                current = []
+        if current:
+            self.blocks.append(Block(current))
+
+        self._block_of = {id(op): block for block in self.blocks for op in block.ops}
+        self._positions = {block: index for index, block in enumerate(self.blocks)}
+        for block in self.blocks:
+            self._link(block)
+        self.invalidate()
+
+    def block_of(self, op: Opcode) -> Block:
+        return self._block_of[id(op)]
+
+    def index(self, block: Block) -> int:
+        return self._positions[block]
+
+    def next_block(self, block: Block) -> Optional[Block]:
+        index = self.index(block) + 1
+        return self.blocks[index] if index < len(self.blocks) else None
+
+    def _break_target(self, block: Block) -> Optional[Block]:
+        # The exit of the innermost loop around `block`: the nearest SETUP_LOOP before it whose target is after it
+        index = self.index(block)
+        for before in reversed(self.blocks[:index + 1]):
+            last = before.last
+            if isinstance(last, SETUP_LOOP) and last.val is not None:
+                target = self._block_of.get(id(last.val))
+                if target is not None and self.index(target) > index:
+                    return target
+        return None
+
+    def _successors(self, block: Block) -> List[Block]:
+        last = block.last
+        successors = []
+        if isinstance(last, JumpOp) and last.val is not None:
+            successors.append(self._block_of[id(last.val)])
+        elif isinstance(last, BREAK_LOOP):
+            target = self._break_target(block)
+            if target is not None:
+                successors.append(target)
+        if block.falls_through():
+            following = self.next_block(block)
+            if following is not None and following not in successors:
+                successors.append(following)
+        return successors
+
+    def _link(self, block: Block):
+        for successor in block.successors:
+            successor.predecessors.remove(block)
+        block.successors = self._successors(block)
+        for successor in block.successors:
+            successor.predecessors.append(block)
+
+    def invalidate(self, blocks: Iterable[Block] = (), edges: bool = True):
+        # Drops cached analyses. Edits that kept the edges only need liveness and the blocks' own summaries redone.
+        for block in blocks:
+            block._uses = block._defs = None
+        if edges:
+            self._reachable = None
+            self._idom = None
+            self._loops = None
+        self._live_in = self._live_out = None
+
+    def replace(self, block: Block, ops: List[Opcode]):
+        # Swaps a block's ops. Jumps to its old first op move to the new one; a jump may only be the last op.
+        if not ops:
+            raise ValueError("Use remove() to delete a block")
+        for op in ops[:-1]:
+            if isinstance(op, (JumpOp,) + TERMINATORS):
+                raise ValueError(f"{op.op_name} can only end a block")
+
+        if ops[0] is not block.first:
+            retarget(block.first, ops[0])
+        kept = {id(op) for op in ops}
+        for op in block.ops:
+            del self._block_of[id(op)]
+            if isinstance(op, JumpOp) and id(op) not in kept:
+                op.val = None
+        old_last = block.last
+        old_successors = block.successors
+        block.ops = list(ops)
+        for op in block.ops:
+            self._block_of[id(op)] = block
+
+        self._link(block)
+        edges = block.successors != old_successors
+        if isinstance(old_last, SETUP_LOOP) or isinstance(block.last, SETUP_LOOP):
+            edges = self._relink_breaks() or edges
+        self.invalidate([block], edges=edges)
+
+    def remove(self, block: Block):
+        # Deletes a block, jumps to it continue at the block after it
+        index = self.index(block)
+        following = self.next_block(block)
+        # The block's own jumps go first, so one back to its start doesn't count as incoming
+        for op in block.ops:
+            if isinstance(op, JumpOp):
+                op.val = None
+            del self._block_of[id(op)]
+        if block.first.incoming:
+            if following is None:
+                raise ValueError("Cannot remove the last block while jumps still target it")
+            retarget(block.first, following.first)
+
+        for successor in block.successors:
+            successor.predecessors.remove(block)
+        del self.blocks[index]
+        self._positions = {item: position for position, item in enumerate(self.blocks)}
+        for predecessor in list(block.predecessors):
+            self._link(predecessor)
+        if isinstance(block.last, SETUP_LOOP):
+            self._relink_breaks()
+        self.invalidate()
+
+    def _relink_breaks(self) -> bool:
+        changed = False
+        for block in self.blocks:
+            if isinstance(block.last, BREAK_LOOP):
+                old = block.successors
+                self._link(block)
+                changed = changed or block.successors != old
+        return changed
+
+    def linearize(self) -> List[Opcode]:
+        ops = [op for block in self.blocks for op in block.ops]
+        sync_ops(ops)
+        return ops
+
+    def reachable(self) -> Set[Block]:
+        if self._reachable is None:
+            seen = {self.entry}
+            stack = [self.entry]
+            while stack:
+                for successor in stack.pop().successors:
+                    if successor not in seen:
+                        seen.add(successor)
+                        stack.append(successor)
+            self._reachable = seen
+        return self._reachable
+
+    def postorder(self) -> List[Block]:
+        order = []
+        seen = {self.entry}
+        stack = [(self.entry, iter(self.entry.successors))]
+        while stack:
+            block, successors = stack[-1]
+            for successor in successors:
+                if successor not in seen:
+                    seen.add(successor)
+                    stack.append((successor, iter(successor.successors)))
+                    break
+            else:
+                stack.pop()
+                order.append(block)
+        return order
+
+    def dominators(self) -> Dict[Block, Block]:
+        # Immediate dominator of every reachable block (Cooper, Harvey & Kennedy), the entry maps to itself
+        if self._idom is None:
+            order = self.postorder()
+            number = {block: index for index, block in enumerate(order)}
+            idom = {self.entry: self.entry}
+
+            def intersect(a: Block, b: Block) -> Block:
+                while a is not b:
+                    while number[a] < number[b]:
+                        a = idom[a]
+                    while number[b] < number[a]:
+                        b = idom[b]
+                return a
+
+            changed = True
+            while changed:
+                changed = False
+                for block in reversed(order):
+                    if block is self.entry:
+                        continue
+                    new = None
+                    for predecessor in block.predecessors:
+                        if predecessor in idom:
+                            new = predecessor if new is None else intersect(predecessor, new)
+                    if idom.get(block) is not new:
+                        idom[block] = new
+                        changed = True
+            self._idom = idom
+        return self._idom
+
+    def dominates(self, a: Block, b: Block) -> bool:
+        idom = self.dominators()
+        if b not in idom:
+            return False
+        while True:
+            if a is b:
+                return True
+            if idom[b] is b:
+                return False
+            b = idom[b]
+
+    def loops(self) -> List[Loop]:
+        # Natural loops from back edges, outermost first, with `parent`/`children` for the nesting
+        if self._loops is None:
+            bodies: Dict[Block, Set[Block]] = {}
+            for block in self.reachable():
+                for successor in block.successors:
+                    if self.dominates(successor, block):
+                        body = bodies.setdefault(successor, {successor})
+                        stack = [block]
+                        while stack:
+                            item = stack.pop()
+                            if item not in body:
+                                body.add(item)
+                                stack.extend(item.predecessors)
+
+            loops = sorted((Loop(header, body) for header, body in bodies.items()), key=lambda loop: -len(loop.blocks))
+            for index, loop in enumerate(loops):
+                for outer in reversed(loops[:index]):
+                    if loop.header in outer.blocks:
+                        loop.parent = outer
+                        outer.children.append(loop)
+                        break
+            self._loops = loops
+        return self._loops
+
+    def loop_of(self, block: Block) -> Optional[Loop]:
+        # The innermost loop containing `block`
+        innermost = None
+        for loop in self.loops():
+            if block in loop.blocks and (innermost is None or len(loop.blocks) < len(innermost.blocks)):
+                innermost = loop
+        return innermost
+
+    def liveness(self) -> Tuple[Dict[Block, FrozenSet[str]], Dict[Block, FrozenSet[str]]]:
+        # (live in, live out) locals per block
+        if self._live_in is None:
+            live_in = {block: frozenset() for block in self.blocks}
+            live_out = dict(live_in)
+            worklist = list(self.blocks)
+            queued = set(worklist)
+            while worklist:
+                block = worklist.pop()
+                queued.discard(block)
+                uses, defs = block.uses_defs()
+                out = frozenset().union(*(live_in[successor] for successor in block.successors))
+                live_out[block] = out
+                new = uses | (out - defs)
+                if new != live_in[block]:
+                    live_in[block] = new
+                    for predecessor in block.predecessors:
+                        if predecessor not in queued:
+                            queued.add(predecessor)
+                            worklist.append(predecessor)
+            self._live_in = live_in
+            self._live_out = live_out
+        return self._live_in, self._live_out
+
+    def live_after(self, op: Opcode) -> FrozenSet[str]:
+        # Locals that may still be read after `op` runs
+        block = self.block_of(op)
+        live = set(self.liveness()[1][block])
+        for item in reversed(block.ops):
+            if item is op:
+                break
+            if isinstance(item, STORE_FAST):
+                live.discard(item.arg)
+            elif isinstance(item, LOAD_FAST):
+                live.add(item.arg)
+        return frozenset(live)
@@ -0,0 +1,109 @@
+import marshal
+import sys
+from importlib.abc import MetaPathFinder
+from importlib.machinery import PathFinder, SourceFileLoader
+from importlib.util import MAGIC_NUMBER, cache_from_source
+from types import CodeType
+from typing import Iterable, Optional
+
+from bytepatches.parser import UnhandledOpcode
+from bytepatches.patchset import PatchSet
+from bytepatches.pyc_parser import FLAGS_MAGIC
+from bytepatches.utils import build_code
+
+
+def patch_nested(patches: PatchSet, code: CodeType) -> CodeType:
+    # Patches a code object and every code object in its constants, skipping the ones the parser can't handle
+    consts = tuple(patch_nested(patches, const) if isinstance(const, CodeType) else const
+                   for const in code.co_consts)
+    if any(new is not old for new, old in zip(consts, code.co_consts)):
+        code = build_code(code, code.co_code, consts=consts)
+    try:
+        return patches.patch_code(code, False)
+    except UnhandledOpcode:
+        return code
+
+
+def pyc_header(mtime: float, size: int) -> bytes:
+    # A timestamp based .pyc header for the running interpreter, with the PEP 552 flags word from 3.7 on
+    flags = bytes(4) if int.from_bytes(MAGIC_NUMBER[:2], "little") >= FLAGS_MAGIC else b""
+    return (MAGIC_NUMBER + flags +
+            (int(mtime) & 0xFFFFFFFF).to_bytes(4, "little") +
+            (size & 0xFFFFFFFF).to_bytes(4, "little"))
+
+
+class PatchingLoader(SourceFileLoader):
+    # Compiles and patches a module's source, caching the result as a .pyc tagged with the rules' fingerprint,
+    # which also changes with the bytepatches sources.
+    # The tag keeps patched bytecode apart from the regular .pyc, which imports without the hook still use.
+
+    def __init__(self, fullname: str, path: str, patches: PatchSet):
+        super().__init__(fullname, path)
+        self.patches = patches
+
+    def cache_path(self, source_path: str) -> Optional[str]:
+        fingerprint = self.patches.fingerprint
+        if fingerprint is None:
+            return None
+        try:
+            return cache_from_source(source_path, optimization=f"bp{fingerprint[:16]}")
+        except NotImplementedError:
+            return None
+
+    def get_code(self, fullname: str) -> CodeType:
+        source_path = self.get_filename(fullname)
+        stats = self.path_stats(source_path)
+        header = pyc_header(stats["mtime"], stats["size"])
+
+        bytecode_path = self.cache_path(source_path)
+        if bytecode_path is not None:
+            try:
+                data = self.get_data(bytecode_path)
+            except OSError:
+                pass
+            else:
+                if data[:len(header)] == header:
+                    try:
+                        return marshal.loads(data[len(header):])
+                    except (EOFError, ValueError, TypeError):
+                        pass  # Rewritten below
+
+        code = patch_nested(self.patches, self.source_to_code(self.get_data(source_path), source_path))
+        if bytecode_path is not None and not sys.dont_write_bytecode:
+            try:
+                self.set_data(bytecode_path, header + marshal.dumps(code))
+            except NotImplementedError:
+                pass
+        return code
+
+
+class PatchingFinder(MetaPathFinder):
+    # Hands modules in `packages` (and their submodules) to a PatchingLoader
+    def __init__(self, patches: PatchSet, packages: Iterable[str]):
+        self.patches = patches
+        self.packages = tuple(packages)
+
+    def matches(self, fullname: str) -> bool:
+        return any(fullname == package or fullname.startswith(package + ".") for package in self.packages)
+
+    def find_spec(self, fullname, path, target=None):
+        if not self.matches(fullname):
+            return None
+        spec = PathFinder.find_spec(fullname, path)
+        if spec is None or not isinstance(spec.loader, SourceFileLoader):
+            return None
+        spec.loader = PatchingLoader(fullname, spec.origin, self.patches)
+        return spec
+
+
+def install(patches: PatchSet, *packages: str) -> PatchingFinder:
+    if not packages:
+        raise ValueError("At least one package to patch is required")
+    finder = PatchingFinder(patches, packages)
+    sys.meta_path.insert(0, finder)
+    return finder
+
+
+def uninstall(finder: PatchingFinder):
+    if finder in sys.meta_path:
+        sys.meta_path.remove(finder)
@@ -0,0 +1,192 @@
+from itertools import zip_longest
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+from bytepatches import stats
+from bytepatches.ops import Opcode, JumpOp, sync_ops, layout_ops, retarget
+
+
+class Match(NamedTuple):
+    start: int
+    end: int
+    pattern: int
+
+
+def arg_matches(pattern: Opcode, arg: Any) -> bool:
+    # `Any` and `$n` captures match every argument
+    return pattern._arg is Any or isinstance(pattern._arg, str) or pattern._arg == arg
+
+
+class PatternSet:
+    # Aho-Corasick automaton over the opcodes of every `before` pattern.
+    # All patterns are found in a single scan; arguments are checked once a pattern's opcodes matched.
+
+    def __init__(self, patterns: Iterable[Tuple[List[Opcode], List[Opcode]]] = ()):
+        self.patterns: List[Tuple[List[Opcode], List[Opcode]]] = []
+        self._goto: List[Dict[int, int]] = []
+        self._fail: List[int] = []
+        self._out: List[List[int]] = []
+        self.positional = False  # Whether a pattern matches jumps by their encoded argument
+        for before, after in patterns:
+            self.add(before, after)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, ops_before: List[Opcode], ops_after: List[Opcode]) -> 'PatternSet':
+        if not ops_before:
+            raise ValueError("Cannot match an empty pattern")
+        if any(op is None for op in ops_before):
+            # The automaton is keyed on opcodes, a wildcard for any op can't be part of it
+            raise ValueError("Patterns cannot contain None, use an op with an Any or $n argument instead")
+        self.patterns.append((list(ops_before), list(ops_after)))
+        self.positional = self.positional or any(isinstance(op, JumpOp) and isinstance(op._arg, int)
+                                                 for op in ops_before)
+        self._goto = []
+        return self
+
+    def compile(self):
+        goto = [{}]
+        out = [[]]
+        for index, (before, _) in enumerate(self.patterns):
+            state = 0
+            for op in before:
+                key = op.op_byte[0]
+                if key not in goto[state]:
+                    goto[state][key] = len(goto)
+                    goto.append({})
+                    out.append([])
+                state = goto[state][key]
+            out[state].append(index)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for key, child in goto[state].items():
+                queue.append(child)
+                node = fail[state]
+                while node and key not in goto[node]:
+                    node = fail[node]
+                fail[child] = goto[node].get(key, 0)
+                out[child] = out[child] + out[fail[child]]
+
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+
+    def scan(self, keys: Iterable[int], arg_at: Callable[[int], Any]) -> List[Match]:
+        # Every match of every pattern, including overlapping ones
+        if not self._goto:
+            self.compile()
+        goto, fail, out = self._goto, self._fail, self._out
+
+        matches = []
+        state = 0
+        for index, key in enumerate(keys):
+            while state and key not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(key, 0)
+            for pattern in out[state]:
+                before = self.patterns[pattern][0]
+                start = index - len(before) + 1
+                if all(arg_matches(op, arg_at(start + i)) for i, op in enumerate(before)):
+                    matches.append(Match(start, index + 1, pattern))
+        return matches
+
+    def select(self, matches: List[Match]) -> List[Match]:
+        # Leftmost matches win, earlier patterns break ties; overlapping matches are dropped
+        selected = []
+        end = 0
+        for match in sorted(matches, key=lambda m: (m.start, m.pattern)):
+            if match.start >= end:
+                selected.append(match)
+                end = match.end
+        return selected
+
+    def find(self, ops: List[Opcode]) -> List[Match]:
+        return self.select(self.scan((op.op_byte[0] for op in ops), lambda index: ops[index]._arg))
+
+    def replacement(self, match: Match, matched: List[Any]) -> List[Opcode]:
+        # Builds fresh `after` ops for a match, filling `$n` captures from the matched ops
+        before, after = self.patterns[match.pattern]
+        captures = {}
+        for pattern, op in zip(before, matched):
+            if isinstance(pattern._arg, str):
+                captures.setdefault(pattern._arg, []).append(op)
+
+        result = []
+        for op in after:
+            source = captures[op._arg].pop(0) if isinstance(op._arg, str) else op
+            result.append(type(op)(source._arg, source.arg, source.val))
+
+        # Links between the pattern's own ops have to point at the copies
+        copies = {id(op): new for op, new in zip(after, result)}
+        for new in result:
+            if id(new.arg) in copies:
+                new.arg = copies[id(new.arg)]
+            if id(new.val) in copies:
+                new.val = copies[id(new.val)]
+            if isinstance(new, JumpOp) and new.val is None:
+                # Its argument would be resolved against offsets that are only laid out when packing
+                raise ValueError(f"{new.op_name} in a replacement must capture its target")
+        return result
+
+    def apply(self, ops: List[Opcode]) -> int:
+        started = stats.start()
+        count = self._apply(ops)
+        stats.stop(started, "match", len(ops), count)
+        return count
+
+    def _apply(self, ops: List[Opcode]) -> int:
+        from bytepatches.stream import InstructionStream
+        if isinstance(ops, InstructionStream):
+            return ops.apply(self)
+
+        if self.positional:
+            layout_ops(ops)  # Offsets are only kept up to date when packing
+        matches = self.find(ops)
+        if not matches:
+            return 0
+
+        result = []
+        moved = {}
+        removed = []
+
+        def keep(run: List[Opcode]):
+            # Jumps to removed ops continue at the next op that is kept
+            if run and removed:
+                for old in removed:
+                    move(old, run[0])
+                removed.clear()
+            result.extend(run)
+
+        def move(old: Opcode, new: Opcode):
+            retarget(old, new)
+            moved[id(old)] = new
+            if isinstance(old, JumpOp):
+                old.val = None
+
+        done = 0
+        for match in matches:
+            keep(ops[done:match.start])
+            matched = ops[match.start:match.end]
+            for old, new in zip_longest(matched, self.replacement(match, matched)):
+                if new is None:
+                    removed.append(old)
+                    continue
+                if isinstance(new, JumpOp) and id(new.val) in moved:
+                    # Captured from a jump whose target was already rewritten
+                    new.val = moved[id(new.val)]
+                if old is not None:
+                    new.set_bytecode_pos(old.bytecode_pos)
+                    new.lineno = old.lineno
+                    move(old, new)
+                keep([new])
+            done = match.end
+
+        keep(ops[done:])
+        for old in removed:
+            move(old, result[-1])
+
+        ops[:] = result
+        sync_ops(ops)
+        return len(matches)
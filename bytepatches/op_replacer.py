@@ -1,125 +1,78 @@
-from itertools import zip_longest
-from typing import List, Union
+from types import CodeType
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
-from bytepatches.ops import Opcode, sync_ops, LOAD_FAST, STORE_FAST, JumpOp, LOAD_NAME, STORE_NAME
-from bytepatches.parser import Parser
-from bytepatches.utils import patch_function, make_bytecode
+from bytepatches import stats
+from bytepatches.assembler import assemble
+from bytepatches.matcher import PatternSet
+from bytepatches.ops import Opcode, LOAD_FAST, STORE_FAST
+from bytepatches.parser import Parser, DECODERS, NAME, CONST, FAST
+from bytepatches.stream import InstructionStream
+from bytepatches.utils import LRUCache, InternTable, const_key
+
+# From inspect, which is slow to import
+CO_VARARGS = 0x04
+CO_VARKEYWORDS = 0x08
 
 
 class OpNotFound(Exception):
     pass
 
 
-def change_ops(ops: List[Opcode], ops_before: List[Opcode], ops_after: List[Opcode]):
-    index = 0
-    found = False
-    _cache = {}
-    indices = []
-    while True:
-        if index == len(ops):
-            if not found:
-                raise OpNotFound("Ops not found!")
-            break
-
-        target = ops[index:index + len(ops_before)]
-
-        if target == ops_before:
-            for existing, op in zip(target, ops_before):
-                if op is not None and isinstance(op._arg, str):
-                    if op._arg not in _cache:
-                        _cache[op._arg] = [existing]
-                    else:
-                        _cache[op._arg].append(existing)
-            found = True
-            indices.append(index)
-
-        index += 1
-
-    for index in indices:
-        for before, after in zip_longest(ops_before, ops_after):
-            if after is not None:
-                if isinstance(after._arg, str):
-                    target = _cache[after._arg].pop(0)
-                    cls = type(after)
-                    after = cls(target._arg, target.arg, target.val)
-
-            if before is None:
-                # Append after
-                ops.insert(index, after)
-            elif after is None:
-                # Remove before
-                # We can't pop because that fucks stuff up, but we can set to None and remove later
-                # Go forwards first
-                new_target = None
-                direction = 1
-                pos = index
-                target = ops[index]
-                ops[index] = None
-                while new_target is None:
-                    pos += direction
-                    try:
-                        new_target = ops[pos]
-                    except IndexError:
-                        direction = -1
-
-                for op in ops:
-                    if isinstance(op, JumpOp) and op.val == target:
-                        if op.reljump():
-                            op._arg = new_target.bytecode_pos - op.bytecode_pos
-                        else:
-                            op._arg = new_target.bytecode_pos
-                        op.val = new_target
-
-            else:
-                # Switch ops
-                for op in ops:
-                    if isinstance(op, JumpOp) and op.val == before:
-                        op.val = after
-                after.set_bytecode_pos(ops[index].bytecode_pos)
-                ops[index] = after
-            index += 1
-
-    for index, item in reversed(list(enumerate(ops))):
-        if item is None:
-            ops.pop(index)
-    sync_ops(ops)
+def change_ops(ops: Union[List[Opcode], InstructionStream], ops_before: List[Opcode], ops_after: List[Opcode]):
+    if not PatternSet([(ops_before, ops_after)]).apply(ops):
+        raise OpNotFound("Ops not found!")
 
 
-def replace(func, before_code: Union[str, List[Opcode]], after_code: Union[str, List[Opcode]], name_to_fast=False):
-    fn_code = func.__code__
-    consts = list(fn_code.co_consts)
-    names = list(fn_code.co_names)
-    varnames = list(fn_code.co_varnames)
-    groups = []
-    if isinstance(before_code, str):
-        before = compile(before_code, "<input>", "exec")
-        groups.append(before)
-    if isinstance(after_code, str):
-        after = compile(after_code, "<input>", "exec")
-        groups.append(after)
-
-    for group in groups:
-        for const in group.co_consts:
-            if const not in consts:
-                consts.append(const)
-        for name in group.co_names:
-            if name not in names:
-                names.append(name)
-        for varname in group.co_varnames:
-            if varname not in varnames:
-                varnames.append(varname)
-    if name_to_fast:
-        for name in names:
-            if name not in varnames:
-                varnames.append(name)
+class Snippet(NamedTuple):
+    code: Optional[CodeType]
+    ops: Tuple[Opcode, ...]
+    refs: Tuple[Tuple[Optional[str], Any], ...]  # (resolver, value) each op's argument refers to
+
+
+pattern_cache = LRUCache(256)
+
+
+def _to_fast(op: Opcode) -> Opcode:
+    if op.op_name == "LOAD_NAME":
+        return LOAD_FAST(op._arg, op.arg, op.val)
+    elif op.op_name == "STORE_NAME":
+        return STORE_FAST(op._arg, op.arg, op.val)
+    return op
+
+
+def _snippet(code: Optional[CodeType], ops: List[Opcode], name_to_fast: bool) -> Snippet:
+    if code is None:
+        return Snippet(None, tuple(ops), ((None, None),) * len(ops))
+
+    tables = {
+        NAME: code.co_names,
+        CONST: code.co_consts,
+        FAST: code.co_varnames + code.co_names if name_to_fast else code.co_varnames,
+    }
+    refs = []
+    for i, op in enumerate(ops):
+        resolver = DECODERS[op.op_byte[0]].resolver
+        if name_to_fast and op.op_name in ("LOAD_NAME", "STORE_NAME"):
+            ops[i] = op = _to_fast(op)
+            resolver = FAST
+        if resolver in tables:
+            refs.append((resolver, tables[resolver][op._arg]))
+        else:
+            refs.append((None, None))
+    return Snippet(code, tuple(ops), tuple(refs))
 
+
+def _compile_pattern(before_code, after_code, name_to_fast: bool) -> Tuple[Snippet, Snippet]:
+    before = after = None
     if isinstance(before_code, str):
-        before_ops = Parser(before_code).parse_bytecode(False)
+        before = compile(before_code, "<input>", "exec", optimize=0)
+        before_ops = Parser(before).parse_bytecode(False)
     else:
         before_ops = before_code
 
     if isinstance(after_code, str):
-        after_ops = Parser(after_code).parse_bytecode(False)
+        after = compile(after_code, "<input>", "exec", optimize=0)
+        after_ops = Parser(after).parse_bytecode(False)
     else:
         after_ops = after_code
 
@@ -131,85 +84,108 @@ def replace(func, before_code: Union[str, List[Opcode]], after_code: Union[str,
         before_ops = before_ops[:-1]
         after_ops = after_ops[:-1]
 
-    if isinstance(before_code, str):
-        for i, op in enumerate(before_ops):
-            if name_to_fast:
-                if op.op_name == "LOAD_NAME":
-                    op = LOAD_FAST(op._arg, op.arg, op.val)
-                elif op.op_name == "STORE_NAME":
-                    op = STORE_FAST(op._arg, op.arg, op.val)
-
-            if "CONST" in op.op_name:
-                val = before.co_consts[op._arg]
-                if op._arg != consts.index(val):
-                    op._arg = consts.index(val)
-            elif "NAME" in op.op_name:
-                val = before.co_names[op._arg]
-                if op._arg != names.index(val):
-                    op._arg = names.index(val)
-            elif "FAST" in op.op_name:
-                group = before.co_varnames
-                if name_to_fast:
-                    group += before.co_names
-                val = group[op._arg]
-                if op._arg != varnames.index(val):
-                    op._arg = varnames.index(val)
-
-            before_ops[i] = op
+    return _snippet(before, list(before_ops), name_to_fast), _snippet(after, list(after_ops), name_to_fast)
+
+
+def compile_pattern(before_code: Union[str, List[Opcode]], after_code: Union[str, List[Opcode]],
+                    name_to_fast=False) -> Tuple[Snippet, Snippet]:
+    if isinstance(before_code, str) and isinstance(after_code, str):
+        return pattern_cache.get((before_code, after_code, name_to_fast),
+                                 lambda: _compile_pattern(before_code, after_code, name_to_fast))
+    return _compile_pattern(before_code, after_code, name_to_fast)
+
+
+def _bind(snippet: Snippet, tables: Dict[str, InternTable]) -> List[Opcode]:
+    # Copies the snippet's ops with their arguments pointing into the target's tables
+    ops = []
+    for op, (resolver, value) in zip(snippet.ops, snippet.refs):
+        if resolver is not None:
+            op = type(op)(tables[resolver].index(value), op.arg, op.val)
+        ops.append(op)
+    return ops
+
+
+def code_tables(code: CodeType) -> Dict[str, InternTable]:
+    return {
+        CONST: InternTable(code.co_consts, const_key),
+        NAME: InternTable(code.co_names),
+        FAST: InternTable(code.co_varnames),
+    }
+
+
+def bind_pattern(tables: Dict[str, InternTable], before: Snippet, after: Snippet,
+                 name_to_fast=False) -> Tuple[List[Opcode], List[Opcode]]:
+    # Adds everything the snippets refer to to the target's tables and binds their ops to it
+    for snippet in (before, after):
+        if snippet.code is not None:
+            for const in snippet.code.co_consts:
+                tables[CONST].add(const)
+            for name in snippet.code.co_names:
+                tables[NAME].add(name)
+            for varname in snippet.code.co_varnames:
+                tables[FAST].add(varname)
+    if name_to_fast:
+        for name in tables[NAME]:
+            tables[FAST].add(name)
 
-    if isinstance(after_code, str):
-        for i, op in enumerate(after_ops):
-            if name_to_fast:
-                if op.op_name == "LOAD_NAME":
-                    op = LOAD_FAST(op._arg, op.arg, op.val)
-                elif op.op_name == "STORE_NAME":
-                    op = STORE_FAST(op._arg, op.arg, op.val)
-
-            if "CONST" in op.op_name:
-                val = after.co_consts[op._arg]
-                if op._arg != consts.index(val):
-                    op._arg = consts.index(val)
-            elif "NAME" in op.op_name:
-                val = after.co_names[op._arg]
-                if op._arg != names.index(val):
-                    op._arg = names.index(val)
-            elif "FAST" in op.op_name:
-                group = after.co_varnames
-                if name_to_fast:
-                    group += after.co_names
-                val = group[op._arg]
-                if op._arg != varnames.index(val):
-                    op._arg = varnames.index(val)
-
-            after_ops[i] = op
-
-    ops = Parser(func).parse_bytecode(False)
-
-    change_ops(ops, before_ops, after_ops)
-
-    names, varnames = optimize_access(ops)
-    payload = make_bytecode(ops)
-    patch_function(func, payload, consts=tuple(consts), names=tuple(names), varnames=tuple(varnames))
+    return _bind(before, tables), _bind(after, tables)
+
+
+def replace(func, before_code: Union[str, List[Opcode]], after_code: Union[str, List[Opcode]], name_to_fast=False):
+    fn_code = func.__code__
+    before, after = compile_pattern(before_code, after_code, name_to_fast)
+    tables = code_tables(fn_code)
+    before_ops, after_ops = bind_pattern(tables, before, after, name_to_fast)
+
+    previous = stats.set_function(fn_code)
+    try:
+        ops = Parser(func).parse_bytecode(False)
+
+        change_ops(ops, before_ops, after_ops)
+
+        names, varnames = optimize_access(ops, fn_code)
+        code = assemble(fn_code, ops, consts=tuple(tables[CONST]), names=names, varnames=varnames)
+        if code is not fn_code:
+            func.__code__ = code
+    finally:
+        stats.restore_function(previous)
     return func
 
 
-def optimize_access(ops: List[Opcode]):
-    accessed_names = []
-    accessed_varnames = []
+def _arg_count(fn_code: CodeType) -> int:
+    return (fn_code.co_argcount + fn_code.co_kwonlyargcount +
+            bool(fn_code.co_flags & CO_VARARGS) + bool(fn_code.co_flags & CO_VARKEYWORDS))
 
-    for op in ops:
-        if isinstance(op, (LOAD_NAME, STORE_NAME)) and op.arg not in accessed_names:
-            accessed_names.append(op.arg)
-        elif isinstance(op, (LOAD_FAST, STORE_FAST)) and op.arg not in accessed_varnames:
-            accessed_varnames.append(op.arg)
 
-    accessed_names = tuple(accessed_names)
-    accessed_varnames = tuple(accessed_varnames)
+def _name_of(op: Opcode) -> str:
+    # Whichever operand the parser resolved the name into
+    if isinstance(op.arg, str):
+        return op.arg
+    if isinstance(op.val, str):
+        return op.val
+    return op.arg[1]  # STORE_ATTR
 
-    for op in ops:
-        if isinstance(op, (LOAD_NAME, STORE_NAME)):
-            op._arg = accessed_names.index(op.arg)
-        elif isinstance(op, (LOAD_FAST, STORE_FAST)):
-            op._arg = accessed_varnames.index(op.arg)
 
+def optimize_access(ops: List[Opcode], fn_code: CodeType = None) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    # Rebuilds co_names/co_varnames from the names the ops use, in a single pass.
+    # With fn_code, arguments keep their slots and unchanged tables are returned as-is.
+    started = stats.start()
+    names = InternTable()
+    varnames = InternTable(fn_code.co_varnames[:_arg_count(fn_code)] if fn_code is not None else ())
+    tables = {NAME: names, FAST: varnames}
+
+    for op in ops:
+        decoder = DECODERS.get(op.op_byte[0])
+        table = decoder and tables.get(decoder.resolver)
+        if table is not None:
+            op._arg = table.add(_name_of(op))
+
+    accessed_names = tuple(names)
+    accessed_varnames = tuple(varnames)
+    if fn_code is not None:
+        if accessed_names == fn_code.co_names:
+            accessed_names = fn_code.co_names
+        if accessed_varnames == fn_code.co_varnames:
+            accessed_varnames = fn_code.co_varnames
+    stats.stop(started, "access", len(ops))
     return accessed_names, accessed_varnames
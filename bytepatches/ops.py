@@ -1,9 +1,11 @@
 import dis
-import sys
 import textwrap
 from pprint import PrettyPrinter
 from struct import pack, unpack
-from typing import Any, List, Union
+from types import CodeType
+from typing import Any, Dict, List, Optional, Union
+
+from bytepatches import stats
 
 VERBOSE = True
 LINE_NUMBERS = False
@@ -13,13 +15,52 @@ def b(byte: int) -> bytes:
     return pack("B", byte)
 
 
+def ext_count(arg: Any) -> int:
+    # Number of EXTENDED_ARG prefixes needed to encode arg
+    if not isinstance(arg, int) or arg <= 0xFF:
+        return 0
+    return (arg.bit_length() - 1) // 8
+
+
 def sync_ops(ops: List['Opcode']):
-    for pos, op in enumerate(ops):
-        if op is not None:
-            op.set_bytecode_pos(pos * 2)
+    # Links jumps to their target ops. Once linked, edits never have to touch them,
+    # so offsets and jump arguments are left stale until layout_ops() runs when the ops are packed.
+    from bytepatches.stream import InstructionStream
+    if isinstance(ops, InstructionStream):
+        ops.sync()
+        return
+
+    started = stats.start()
+    # Jumps that have not been loaded yet are resolved against the offsets their argument was encoded with
+    targets = None
     for op in ops:
-        if hasattr(op, "load"):
-            op.load(ops)
+        if isinstance(op, JumpOp) and not op.val:
+            if targets is None:
+                targets = {target.bytecode_pos: target for target in ops if target is not None}
+            op.load(targets)
+    stats.stop(started, "sync", len(ops))
+
+
+def layout_ops(ops: List['Opcode']):
+    # Assigns every op its offset and every jump its argument
+    started = stats.start()
+    # Lay out the ops until no jump needs a different amount of EXTENDED_ARG prefixes
+    changed = True
+    while changed:
+        pos = 0
+        for op in ops:
+            if op is not None:
+                op.set_bytecode_pos(pos)
+                pos += op.size()
+
+        changed = False
+        for op in ops:
+            if isinstance(op, JumpOp):
+                size = op.size()
+                op.update()
+                changed = changed or op.size() != size
+
+    stats.stop(started, "layout", len(ops))
 
 
 NULL_BYTE = b(0)
@@ -27,6 +68,8 @@ NULL_BYTE = b(0)
 
 class OpCodePrinter(PrettyPrinter):
     def _format(self, obj, stream, indent, allowance, *args, **kwargs):
+        if isinstance(obj, LazyCode):
+            obj = obj.parse()
         if hasattr(obj, "__pformat__"):
             max_width = self._width - indent - allowance
             if len(str(obj)) > max_width:
@@ -39,6 +82,44 @@ class OpCodePrinter(PrettyPrinter):
 pretty_printer = OpCodePrinter()
 
 
+class LazyCode:
+    # Stands in for a nested code object until its ops are needed
+    __slots__ = ("code", "tree", "_parsed")
+
+    def __init__(self, code: CodeType, tree: bool):
+        self.code = code
+        self.tree = tree
+        self._parsed = None
+
+    def parse(self):
+        if self._parsed is None:
+            from bytepatches.parser import Parser
+            self._parsed = Parser(self.code).parse_bytecode(self.tree)
+        return self._parsed
+
+    def __getattr__(self, item):
+        if item.startswith("__"):
+            raise AttributeError(item)
+        return getattr(self.parse(), item)
+
+    def __getitem__(self, item):
+        return self.parse()[item]
+
+    def __iter__(self):
+        return iter(self.parse())
+
+    def __len__(self):
+        return len(self.parse())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyCode):
+            other = other.parse()
+        return self.parse() == other
+
+    def __repr__(self):
+        return repr(self.parse())
+
+
 class Context:
     def __init__(self, names: tuple = None, consts: tuple = None, varnames: tuple = None):
         self.names = names or tuple()
@@ -50,12 +131,11 @@ class Context:
             return self.names[name]
         return name
 
-    def load_const(self, const: int):
+    def load_const(self, const: int, tree: bool = True):
         if self.consts:
             c = self.consts[const]
-            if c.__class__.__name__ == "code":
-                from bytepatches.parser import Parser
-                return Parser(c).parse_bytecode(sys._getframe().f_back.f_locals["tree"])
+            if isinstance(c, CodeType):
+                return LazyCode(c, tree)
             return c
         return const
 
@@ -65,11 +145,21 @@ class Context:
         return varname
 
 
+def retarget(old: 'Opcode', new: 'Opcode'):
+    # Points every jump targeting `old` at `new`
+    if old.incoming:
+        for jump in list(old.incoming.values()):
+            jump.val = new
+
+
 class Opcode:
+    __slots__ = ("bytecode_pos", "_arg", "arg", "val", "incoming", "lineno")
     op_byte: bytes = b(0)
 
     def __init__(self, arg: Union[int, str] = None, arg_obj: Any = None, val_obj: Any = None):
         self.bytecode_pos = 0
+        self.incoming: Dict[int, JumpOp] = None
+        self.lineno: Optional[int] = None  # Source line the op was parsed from, None for ops added by patches
         self._arg = arg
         self.arg = arg_obj
         self.val = val_obj
@@ -93,12 +183,25 @@ class Opcode:
     def set_bytecode_pos(self, pos: int):
         self.bytecode_pos = pos
 
+    def stack_effect(self) -> int:
+        opcode = self.op_byte[0]
+        return dis.stack_effect(opcode, self._arg if opcode >= dis.HAVE_ARGUMENT else None)
+
     @property
     def op_name(self):
         return self.__class__.__name__
 
+    def size(self) -> int:
+        return 2 * (ext_count(self._arg) + 1)
+
     def pack(self):
-        return self.op_byte + b(self._arg)
+        arg = self._arg
+        count = ext_count(arg)
+        if not count:
+            return self.op_byte + b(arg)
+        prefix = b"".join(EXTENDED_ARG.op_byte + b((arg >> shift) & 0xFF)
+                          for shift in range(8 * count, 0, -8))
+        return prefix + self.op_byte + b(arg & 0xFF)
 
     def __repr__(self) -> str:
         if not VERBOSE:
@@ -125,8 +228,28 @@ class Opcode:
 
 
 class JumpOp(Opcode):
+    __slots__ = ("_target", "_val")
     op_byte = b(0)
-    _target = 0
+
+    def __init__(self, arg: Union[int, str] = None, arg_obj: Any = None, val_obj: Any = None):
+        self._val = None
+        super().__init__(arg, arg_obj, val_obj)
+        self._target = 0
+
+    @property
+    def val(self) -> Opcode:
+        return self._val
+
+    @val.setter
+    def val(self, target: Opcode):
+        # Keeps the target's index of incoming jumps up to date
+        if self._val is not None and self._val.incoming:
+            self._val.incoming.pop(id(self), None)
+        self._val = target
+        if isinstance(target, Opcode):
+            if target.incoming is None:
+                target.incoming = {}
+            target.incoming[id(self)] = self
 
     def reljump(self) -> bool:
         return unpack("B", self.op_byte)[0] in dis.hasjrel
@@ -135,167 +258,213 @@ class JumpOp(Opcode):
         self._arg = self._target
         return super().pack()
 
-    def load(self, ops):
+    def load(self, targets: Dict[int, Opcode]):
         if not self.val:
             # Initial load, get target op
             if self.reljump():
-                target_op_pos = (self.bytecode_pos + self._arg + 2) / 2
+                target_op_pos = self.bytecode_pos + self.size() + self._arg
             else:
-                target_op_pos = self._arg / 2
-            self.val = ops[int(target_op_pos)]
+                target_op_pos = self._arg
+            self.val = targets[target_op_pos]
         else:
-            if self.reljump():
-                self._target = self.val.bytecode_pos - self.bytecode_pos - 2
-            else:
-                self._target = self.val.bytecode_pos
+            self.update()
+
+    def update(self):
+        if self.reljump():
+            self._target = self.val.bytecode_pos - self.bytecode_pos - self.size()
+        else:
+            self._target = self.val.bytecode_pos
+        self._arg = self._target
 
 
 # TODO: Add all opcodes
 
 
 class NOP(Opcode):
+    __slots__ = ()
     op_byte = b(0)
 
 
 class POP_TOP(Opcode):
+    __slots__ = ()
     op_byte = b(1)
 
 
 class BINARY_POWER(Opcode):
+    __slots__ = ()
     op_byte = b(19)
 
 
 class BINARY_MULTIPLY(Opcode):
+    __slots__ = ()
     op_byte = b(20)
 
 
 class BINARY_MODULO(Opcode):
+    __slots__ = ()
     op_byte = b(22)
 
 
 class BINARY_ADD(Opcode):
+    __slots__ = ()
     op_byte = b(23)
 
 
 class BINARY_SUBTRACT(Opcode):
+    __slots__ = ()
     op_byte = b(24)
 
 
 class BINARY_SUBSCR(Opcode):
+    __slots__ = ()
     op_byte = b(25)
 
 
 class BINARY_FLOOR_DIVIDE(Opcode):
+    __slots__ = ()
     op_byte = b(26)
 
 
 class BINARY_TRUE_DIVIDE(Opcode):
+    __slots__ = ()
     op_byte = b(27)
 
 
 class GET_ITER(Opcode):
+    __slots__ = ()
     op_byte = b(68)
 
 
 class BREAK_LOOP(Opcode):
+    __slots__ = ()
     op_byte = b(80)
 
 
 class RETURN_VALUE(Opcode):
+    __slots__ = ()
     op_byte = b(83)
 
 
 class YIELD_VALUE(Opcode):
+    __slots__ = ()
     op_byte = b(86)
 
 
 class POP_BLOCK(Opcode):
+    __slots__ = ()
     op_byte = b(87)
 
 
 class STORE_NAME(Opcode):
+    __slots__ = ()
     op_byte = b(90)
 
 
 class FOR_ITER(JumpOp):  # JumpOp because it has a referenced target
+    __slots__ = ()
     op_byte = b(93)
 
 
 class STORE_ATTR(Opcode):
+    __slots__ = ()
     op_byte = b(95)
 
 
 class LOAD_CONST(Opcode):
+    __slots__ = ()
     op_byte = b(100)
 
 
 class LOAD_NAME(Opcode):
+    __slots__ = ()
     op_byte = b(101)
 
 
 class LOAD_ATTR(Opcode):
+    __slots__ = ()
     op_byte = b(106)
 
 
 class COMPARE_OP(Opcode):
+    __slots__ = ()
     op_byte = b(107)
 
 
 class IMPORT_NAME(Opcode):
+    __slots__ = ()
     op_byte = b(108)
 
 
 class IMPORT_FROM(Opcode):
+    __slots__ = ()
     op_byte = b(109)
 
 
 class JUMP_FORWARD(JumpOp):
+    __slots__ = ()
     op_byte = b(110)
 
 
 class JUMP_IF_TRUE_OR_POP(JumpOp):
+    __slots__ = ()
     op_byte = b(112)
 
 
 class JUMP_ABSOLUTE(JumpOp):
+    __slots__ = ()
     op_byte = b(113)
 
 
 class POP_JUMP_IF_FALSE(JumpOp):
+    __slots__ = ()
     op_byte = b(114)
 
 
 class LOAD_GLOBAL(Opcode):
+    __slots__ = ()
     op_byte = b(116)
 
 
 class SETUP_LOOP(JumpOp):
+    __slots__ = ()
     op_byte = b(120)
 
 
 class LOAD_FAST(Opcode):
+    __slots__ = ()
     op_byte = b(124)
 
 
 class STORE_FAST(Opcode):
+    __slots__ = ()
     op_byte = b(125)
 
 
 class CALL_FUNCTION(Opcode):
+    __slots__ = ()
     op_byte = b(131)
 
 
 class MAKE_FUNCTION(Opcode):
+    __slots__ = ()
     op_byte = b(132)
 
 
+class EXTENDED_ARG(Opcode):
+    __slots__ = ()
+    op_byte = b(144)
+
+
 class BUILD_CONST_KEY_MAP(Opcode):
+    __slots__ = ()
     op_byte = b(156)
 
 
 class LOAD_METHOD(Opcode):
+    __slots__ = ()
     op_byte = b(160)
 
 
 class CALL_METHOD(Opcode):
+    __slots__ = ()
     op_byte = b(161)
@@ -0,0 +1,532 @@
+import operator
+from collections import defaultdict, deque
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
+
+from bytepatches import stats
+from bytepatches.cfg import Block, CFG, Loop
+from bytepatches.ops import Opcode, JumpOp, LOAD_FAST, STORE_FAST, POP_BLOCK, BREAK_LOOP, RETURN_VALUE, YIELD_VALUE, \
+    LOAD_CONST, BINARY_POWER, BINARY_MULTIPLY, BINARY_MODULO, BINARY_ADD, BINARY_SUBTRACT, \
+    BINARY_SUBSCR, BINARY_FLOOR_DIVIDE, BINARY_TRUE_DIVIDE, POP_TOP, JUMP_FORWARD, JUMP_ABSOLUTE, POP_JUMP_IF_FALSE, \
+    JUMP_IF_TRUE_OR_POP, SETUP_LOOP, FOR_ITER, LOAD_ATTR, STORE_ATTR, LOAD_METHOD, CALL_METHOD, CALL_FUNCTION, sync_ops, \
+    retarget
+from bytepatches.parser import DECODERS
+from bytepatches.utils import InternTable
+
+# Names stored by module and class bodies outlive the code, so only locals are propagated
+LOADS = {LOAD_FAST: STORE_FAST}
+STORES = (STORE_FAST,)
+
+# Values are never propagated across ops that leave or enter a block
+BARRIERS = (JumpOp, POP_BLOCK, BREAK_LOOP, RETURN_VALUE, YIELD_VALUE)
+
+Link = Tuple[Opcode, str, Optional[int]]
+
+
+class Propagated(NamedTuple):
+    loads: int
+    stores: int
+
+
+def children(op: Opcode):
+    # (attribute, index in a tuple/list operand or None, child) for each expression tree child
+    for attr in ("arg", "val"):
+        if attr == "val" and isinstance(op, JumpOp):
+            continue  # The jump target, not an operand
+        value = getattr(op, attr)
+        if isinstance(value, Opcode):
+            yield attr, None, value
+        elif isinstance(value, (tuple, list)):
+            for index, item in enumerate(value):
+                if isinstance(item, Opcode):
+                    yield attr, index, item
+
+
+def parent_links(ops: List[Opcode]) -> Dict[int, Link]:
+    return {id(child): (op, attr, index)
+            for op in ops if op is not None
+            for attr, index, child in children(op)}
+
+
+def replace_child(link: Link, new: Opcode):
+    parent, attr, index = link
+    if index is None:
+        setattr(parent, attr, new)
+        return
+    items = getattr(parent, attr)
+    if isinstance(items, tuple):
+        setattr(parent, attr, items[:index] + (new,) + items[index + 1:])
+    else:
+        items[index] = new
+
+
+def _forwardable(ops: List[Opcode], store: int, load: int) -> Optional[bool]:
+    # Whether the stored value can stay on the stack until the load:
+    # None if it never can, False if it can't yet because an op in between still needs the stack below it
+    if ops[load].incoming:
+        return None
+
+    depth = 0
+    blocked = False
+    for op in ops[store + 1:load]:
+        if op is None:
+            continue
+        decoder = DECODERS.get(op.op_byte[0])
+        if decoder is None or op.incoming or isinstance(op, BARRIERS):
+            return None
+        if type(op) is type(ops[store]) and op.arg == ops[store].arg:
+            return None
+
+        effect = op.stack_effect()
+        if depth < decoder.pushes - effect:
+            blocked = True
+        depth += effect
+
+    if depth != 0:
+        return None
+    return not blocked
+
+
+def propagate_copies(ops: List[Opcode]) -> Propagated:
+    # Removes `STORE x ... LOAD x` pairs where the load is the only use of the store,
+    # leaving the stored value on the stack for the op that consumed the load.
+    started = stats.start()
+    uses = defaultdict(list)
+    stores = []
+    for index, op in enumerate(ops):
+        if type(op) in LOADS:
+            uses[LOADS[type(op)], op.arg].append(index)
+        elif isinstance(op, STORES):
+            stores.append(index)
+
+    parents = parent_links(ops)
+    worklist = deque(stores)
+    deferred = []
+    removed = 0
+
+    while worklist:
+        index = worklist.popleft()
+        store = ops[index]
+        loads = uses[type(store), store.arg]
+        if len(loads) != 1 or loads[0] < index:
+            continue
+
+        verdict = _forwardable(ops, index, loads[0])
+        if verdict is None:
+            continue
+        if verdict is False:
+            deferred.append(index)
+            continue
+
+        load = ops[loads[0]]
+        ops[index] = ops[loads[0]] = None
+        link = parents.pop(id(load), None)
+        if link is not None:
+            replace_child(link, store.val)
+            parents[id(store.val)] = link
+        if store.incoming:
+            after = loads[0] + 1
+            while ops[after] is None:
+                after += 1
+            retarget(store, ops[after])
+        loads.clear()
+        removed += 1
+
+        # The stack is a level higher between the removed ops, which may unblock deferred stores
+        worklist.extend(deferred)
+        deferred.clear()
+
+    ops[:] = [op for op in ops if op is not None]
+    sync_ops(ops)
+    stats.stop(started, "propagate", len(ops), removed)
+    return Propagated(removed, removed)
+
+
+BINARY_OPERATORS = {
+    BINARY_POWER: operator.pow,
+    BINARY_MULTIPLY: operator.mul,
+    BINARY_MODULO: operator.mod,
+    BINARY_ADD: operator.add,
+    BINARY_SUBTRACT: operator.sub,
+    BINARY_SUBSCR: operator.getitem,
+    BINARY_FLOOR_DIVIDE: operator.floordiv,
+    BINARY_TRUE_DIVIDE: operator.truediv,
+}
+
+# Same limits as CPython's own folding
+MAX_INT_SIZE = 128  # bits
+MAX_COLLECTION_SIZE = 256
+MAX_STR_SIZE = 4096
+
+FOLDABLE = (int, float, complex, str, bytes, tuple)
+
+
+def _is_foldable(value) -> bool:
+    if isinstance(value, tuple):
+        return all(_is_foldable(item) for item in value)
+    return isinstance(value, FOLDABLE)
+
+
+def _fits(value) -> bool:
+    if isinstance(value, int):
+        return value.bit_length() <= MAX_INT_SIZE
+    if isinstance(value, (str, bytes)):
+        return len(value) <= MAX_STR_SIZE
+    if isinstance(value, tuple):
+        return len(value) <= MAX_COLLECTION_SIZE and all(_fits(item) for item in value)
+    return True
+
+
+def _would_fit(cls, left, right) -> bool:
+    # Checked before evaluating the ops that can build huge values out of small operands
+    if cls is BINARY_POWER and isinstance(left, int) and isinstance(right, int) and right > 0:
+        return left.bit_length() * right <= MAX_INT_SIZE
+    if cls is BINARY_MULTIPLY:
+        if isinstance(left, int) and isinstance(right, (str, bytes, tuple)):
+            left, right = right, left
+        if isinstance(left, (str, bytes, tuple)) and isinstance(right, int):
+            limit = MAX_COLLECTION_SIZE if isinstance(left, tuple) else MAX_STR_SIZE
+            return right <= 0 or len(left) * right <= limit
+    if cls is BINARY_MODULO and isinstance(left, (str, bytes)):
+        return False  # Formatting, not arithmetic
+    return True
+
+
+def evaluate(op: Opcode, left: Any, right: Any) -> Tuple[bool, Any]:
+    # (folded, value) of a binary op applied to two constants
+    if not (_is_foldable(left) and _is_foldable(right) and _would_fit(type(op), left, right)):
+        return False, None
+    try:
+        value = BINARY_OPERATORS[type(op)](left, right)
+    except Exception:
+        return False, None  # Left for the interpreter to raise at runtime
+    if not _is_foldable(value) or not _fits(value):
+        return False, None
+    return True, value
+
+
+def fold_constants(ops: List[Opcode], consts: InternTable) -> int:
+    # Replaces `LOAD_CONST a; LOAD_CONST b; BINARY_x` with a single LOAD_CONST of the result.
+    # Results are folded again with the ops they feed into, so whole constant subtrees become one load.
+    started = stats.start()
+    parents = parent_links(ops)
+    result = []
+    folded = 0
+
+    for op in ops:
+        result.append(op)
+        if type(op) not in BINARY_OPERATORS or len(result) < 3:
+            continue
+        first, second = result[-3], result[-2]
+        if not (isinstance(first, LOAD_CONST) and isinstance(second, LOAD_CONST)):
+            continue
+        # Nothing jumps in between, so the two loads are what the op pops, whether or not the parse tree says so.
+        # Ops inserted by replace rules aren't linked into the tree of the code around them.
+        if second.incoming or op.incoming:
+            continue
+
+        ok, value = evaluate(op, first.arg, second.arg)
+        if not ok:
+            continue
+
+        new = LOAD_CONST(consts.add(value), value)
+        new.lineno = first.lineno
+        del result[-3:]
+        result.append(new)
+        retarget(first, new)
+        link = parents.pop(id(op), None)
+        if link is not None:
+            replace_child(link, new)
+            parents[id(new)] = link
+        folded += 1
+
+    if folded:
+        ops[:] = result
+        sync_ops(ops)
+    stats.stop(started, "fold", len(ops), folded)
+    return folded
+
+
+class Eliminated(NamedTuple):
+    blocks: int
+    jumps: int
+
+
+# Constants whose truth value can be taken at patch time
+TRUTH_TYPES = (type(None), bool, int, float, complex, str, bytes, tuple, frozenset)
+
+
+def _const_branch(block: Block) -> Optional[List[Opcode]]:
+    # The ops a block ending in a jump on a constant reduces to, or None
+    if len(block.ops) < 2 or not isinstance(block.ops[-2], LOAD_CONST):
+        return None
+    const, jump = block.ops[-2:]
+    if not isinstance(const.arg, TRUTH_TYPES) or not isinstance(jump, (POP_JUMP_IF_FALSE, JUMP_IF_TRUE_OR_POP)):
+        return None
+
+    taken = bool(const.arg) == isinstance(jump, JUMP_IF_TRUE_OR_POP)
+    if not taken:
+        return block.ops[:-2]
+    new = JUMP_ABSOLUTE(0)
+    new.val = jump.val
+    if isinstance(jump, JUMP_IF_TRUE_OR_POP):
+        return block.ops[:-1] + [new]  # The value stays on the stack
+    return block.ops[:-2] + [new]
+
+
+def _jump_to_next(cfg: CFG, block: Block) -> Optional[List[Opcode]]:
+    # The ops a block ending in a jump to the very next op reduces to, or None
+    jump = block.last
+    following = cfg.next_block(block)
+    if following is None or not isinstance(jump, (JUMP_FORWARD, JUMP_ABSOLUTE, POP_JUMP_IF_FALSE)):
+        return None
+    if jump.val is not following.first:
+        return None
+    if isinstance(jump, POP_JUMP_IF_FALSE):
+        return block.ops[:-1] + [POP_TOP(0)]  # Still has to pop the condition
+    return block.ops[:-1]
+
+
+def eliminate_dead_code(ops: List[Opcode], max_rounds: int = 16) -> Eliminated:
+    # Resolves branches on constants, drops jumps to the next op and removes blocks nothing can reach
+    started = stats.start()
+    cfg = CFG(ops)
+    removed_blocks = removed_jumps = 0
+
+    for _ in range(max_rounds):
+        changed = False
+        for block in list(cfg):
+            new = _const_branch(block)
+            if new is None:
+                new = _jump_to_next(cfg, block)
+            if new is None:
+                continue
+            if new:
+                cfg.replace(block, new)
+            else:
+                cfg.remove(block)
+            removed_jumps += 1
+            changed = True
+
+        reachable = cfg.reachable()
+        for block in [block for block in cfg if block not in reachable]:
+            cfg.remove(block)
+            removed_blocks += 1
+            changed = True
+
+        if not changed:
+            break
+
+    if removed_blocks or removed_jumps:
+        ops[:] = cfg.linearize()
+    stats.stop(started, "dce", len(ops), removed_blocks + removed_jumps)
+    return Eliminated(removed_blocks, removed_jumps)
+
+
+UNCONDITIONAL = (JUMP_FORWARD, JUMP_ABSOLUTE)
+
+
+def _final_target(jump: JumpOp) -> Opcode:
+    # Follows unconditional jumps from the jump's target to where execution actually continues
+    target = jump.val
+    seen = {id(jump)}
+    while isinstance(target, UNCONDITIONAL) and id(target) not in seen and target.val is not None:
+        seen.add(id(target))
+        target = target.val
+    return target
+
+
+def _swap(old: Opcode, new: Opcode) -> Opcode:
+    retarget(old, new)
+    new.set_bytecode_pos(old.bytecode_pos)
+    new.lineno = old.lineno
+    if isinstance(old, JumpOp):
+        old.val = None
+    return new
+
+
+def thread_jumps(ops: List[Opcode], max_rounds: int = 16) -> int:
+    # Points jumps past the unconditional jumps they land on, turns jumps to a return into the return
+    # and drops jumps to the next op. SETUP_LOOP and FOR_ITER keep their targets.
+    started = stats.start()
+    changes = 0
+
+    for _ in range(max_rounds):
+        ops[:] = [op for op in ops if op is not None]
+        sync_ops(ops)
+        following = {id(op): after for op, after in zip(ops, ops[1:])}
+        order = {id(op): index for index, op in enumerate(ops)}
+        result = []
+        changed = 0
+
+        for op in ops:
+            if not isinstance(op, (JUMP_FORWARD, JUMP_ABSOLUTE, POP_JUMP_IF_FALSE, JUMP_IF_TRUE_OR_POP)):
+                result.append(op)
+                continue
+
+            after = following.get(id(op))
+            final = _final_target(op)
+            if final is not op.val:
+                if isinstance(op, JUMP_FORWARD) and order[id(final)] <= order[id(op)]:
+                    op = _swap(op, JUMP_ABSOLUTE(0))  # Relative jumps only go forward
+                op.val = final
+                changed += 1
+
+            if after is not None and op.val is after and not isinstance(op, JUMP_IF_TRUE_OR_POP):
+                if isinstance(op, POP_JUMP_IF_FALSE):
+                    result.append(_swap(op, POP_TOP(0)))  # The condition still has to be popped
+                else:
+                    _swap(op, after)
+                changed += 1
+                continue
+
+            if isinstance(op, UNCONDITIONAL):
+                returned = None
+                if isinstance(op.val, RETURN_VALUE):
+                    returned = [RETURN_VALUE(0)]
+                elif isinstance(op.val, LOAD_CONST) and isinstance(following.get(id(op.val)), RETURN_VALUE):
+                    returned = [LOAD_CONST(op.val._arg, op.val.arg), RETURN_VALUE(0)]
+                if returned is not None:
+                    _swap(op, returned[0])
+                    result.extend(returned)
+                    changed += 1
+                    continue
+
+            result.append(op)
+
+        ops[:] = result
+        changes += changed
+        if not changed:
+            break
+
+    sync_ops(ops)
+    stats.stop(started, "thread", len(ops), changes)
+    return changes
+
+
+def _method_call(ops: List[Opcode], start: int) -> Optional[int]:
+    # Index of the CALL_METHOD consuming the LOAD_METHOD at `start`, None if a jump comes first
+    nested = 0
+    for index in range(start + 1, len(ops)):
+        op = ops[index]
+        if isinstance(op, JumpOp) or op.incoming:
+            return None
+        if isinstance(op, LOAD_METHOD):
+            nested += 1
+        elif isinstance(op, CALL_METHOD):
+            if not nested:
+                return index
+            nested -= 1
+    return None
+
+
+def _invariant_loads(ops: List[Opcode], setup: int, end: int, attributes: FrozenSet[str]) -> Dict[str, List[int]]:
+    # "x.y" -> indices of the LOAD_FAST x ops followed by a flagged LOAD_ATTR/LOAD_METHOD y between setup and end
+    stored = {op.arg for op in ops[setup + 1:end] if isinstance(op, STORE_FAST)}
+    assigned = {op.arg[1] for op in ops[setup + 1:end] if isinstance(op, STORE_ATTR)}
+    loads = defaultdict(list)
+    for index in range(setup + 1, end - 1):
+        op, attribute = ops[index], ops[index + 1]
+        if not isinstance(op, LOAD_FAST) or not isinstance(attribute, (LOAD_ATTR, LOAD_METHOD)):
+            continue
+        if op.arg in stored or attribute.val in assigned or attribute.incoming:
+            continue
+        name = f"{op.arg}.{attribute.val}"
+        if attribute.val in attributes or name in attributes:
+            loads[name].append(index)
+    return loads
+
+
+def _loop_at(cfg: CFG, order: Dict[int, int], setup: int, end: int) -> Optional[Loop]:
+    # The loop a SETUP_LOOP sets up: the one whose header comes first between it and its target
+    found = None
+    for loop in cfg.loops():
+        position = order[id(loop.header.first)]
+        if setup < position < end and (found is None or position < order[id(found.header.first)]):
+            found = loop
+    return found
+
+
+def _runs_first(cfg: CFG, loop: Loop, peel: bool) -> Callable[[Opcode], bool]:
+    # Whether an op in the loop runs in the first iteration before the loop can be left or go around again:
+    # its block dominates every block of the body that jumps back, continues, breaks or returns
+    body = loop.blocks - {loop.header} if peel else loop.blocks
+    exits = [block for block in body
+             if not block.successors or any(successor not in body or successor is loop.header
+                                            for successor in block.successors)]
+    return lambda op: all(cfg.dominates(cfg.block_of(op), block) for block in exits)
+
+
+def hoist_invariants(ops: List[Opcode], fast: InternTable, attributes: Iterable[str]) -> int:
+    # Loads `x.y` once per loop into a local named "x.y", for flagged attributes of locals the loop never stores.
+    # Attributes are flagged as "y" or "x.y"; bound methods are cached too, and their CALL_METHOD becomes CALL_FUNCTION.
+    # Only loads the first iteration would run anyway are moved, so a loop that never runs its body loads nothing.
+    # For loops are peeled to load right after their first FOR_ITER, while loops load in front of the loop.
+    started = stats.start()
+    attributes = frozenset(attributes)
+    ops[:] = [op for op in ops if op is not None]
+    sync_ops(ops)
+    hoisted = 0
+
+    # Outer loops come first, so loads are moved out of the outermost loop they are invariant in
+    index = 0
+    while index < len(ops):
+        setup = ops[index]
+        index += 1
+        if not isinstance(setup, SETUP_LOOP) or setup.val is None:
+            continue
+        order = {id(op): position for position, op in enumerate(ops)}
+        end = order[id(setup.val)]
+        cfg = CFG(ops)
+        loop = _loop_at(cfg, order, index - 1, end)
+        if loop is None:
+            continue
+        header = loop.header
+        peel = isinstance(header.last, FOR_ITER)
+        runs_first = _runs_first(cfg, loop, peel)
+
+        prologue = []
+        rewrites = []
+        for name, positions in _invariant_loads(ops, index - 1, end, attributes).items():
+            if not any(runs_first(ops[position]) for position in positions):
+                continue
+            calls = [_method_call(ops, position + 1) if isinstance(ops[position + 1], LOAD_METHOD) else None
+                     for position in positions]
+            usable = [(position, call) for position, call in zip(positions, calls)
+                      if call is not None or isinstance(ops[position + 1], LOAD_ATTR)]
+            if not usable:
+                continue
+            slot = fast.add(name)
+            load, attribute = ops[positions[0]:positions[0] + 2]
+            owner = LOAD_FAST(load._arg, load.arg)
+            prologue += [owner, LOAD_ATTR(attribute._arg, owner, attribute.val), STORE_FAST(slot, name)]
+            rewrites += [(position, call, slot, name) for position, call in usable]
+        if not prologue:
+            continue
+
+        for position, call, slot, name in rewrites:
+            if call is not None:
+                ops[call] = _swap(ops[call], CALL_FUNCTION(ops[call]._arg))
+            ops[position] = _swap(ops[position], LOAD_FAST(slot, name))
+            ops[position + 1] = None
+        ops[:] = [op for op in ops if op is not None]
+
+        first = header.first
+        if peel:
+            # The FOR_ITER the loop is entered through is copied, the original stays the target of the back edges
+            position = next(position for position, op in enumerate(ops) if op is first)
+            entry = FOR_ITER(0)
+            entry.val = first.val
+            skip = JUMP_ABSOLUTE(0)
+            skip.val = ops[position + 1]
+            prologue = [entry] + prologue + [skip]
+        else:
+            retarget(setup, prologue[0])
+            position = index - 1
+        for op in prologue:
+            op.lineno = first.lineno
+        ops[position:position] = prologue
+        hoisted += len(rewrites)
+
+    sync_ops(ops)
+    stats.stop(started, "hoist", len(ops), hoisted)
+    return hoisted
@@ -1,58 +1,157 @@
-import struct
-from io import BytesIO
-from typing import List
-
-from bytepatches.ops import Context, Opcode, NOP, sync_ops
+import dis
+from functools import partial
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple, Type, Union
+
+from bytepatches import stats
+from bytepatches.ops import Context, Opcode, NOP, sync_ops, POP_TOP, BINARY_POWER, BINARY_MULTIPLY, \
+    BINARY_MODULO, BINARY_ADD, BINARY_SUBTRACT, BINARY_SUBSCR, BINARY_FLOOR_DIVIDE, BINARY_TRUE_DIVIDE, GET_ITER, \
+    BREAK_LOOP, RETURN_VALUE, YIELD_VALUE, POP_BLOCK, STORE_NAME, FOR_ITER, STORE_ATTR, LOAD_CONST, LOAD_NAME, \
+    LOAD_ATTR, COMPARE_OP, IMPORT_NAME, IMPORT_FROM, JUMP_FORWARD, JUMP_IF_TRUE_OR_POP, JUMP_ABSOLUTE, \
+    POP_JUMP_IF_FALSE, LOAD_GLOBAL, SETUP_LOOP, LOAD_FAST, STORE_FAST, CALL_FUNCTION, MAKE_FUNCTION, \
+    BUILD_CONST_KEY_MAP, LOAD_METHOD, CALL_METHOD, EXTENDED_ARG
+
+# Argument resolvers
+NAME = "name"
+CONST = "const"
+FAST = "fast"
+JUMP = "jump"  # Resolved by sync_ops once all ops are known
+
+# Operand slots, in the order they are passed to the Opcode constructor
+ARG = "arg"  # The resolved argument
+TOP = -1  # Pop the top of the tree
+SECOND = -2  # Pop the item below the top of the tree
+
+
+class UnhandledOpcode(Exception):
+    pass
+
+
+def iter_instructions(code) -> Iterator[Tuple[int, int, int]]:
+    # Yields (offset, opcode, arg) with EXTENDED_ARG prefixes folded into the op they extend
+    view = memoryview(code)
+    extended_arg = EXTENDED_ARG.op_byte[0]
+    ext = 0
+    start = 0
+    for offset, opcode, arg in zip(range(0, len(view), 2), view[::2], view[1::2]):
+        if opcode == extended_arg:
+            ext = (ext | arg) << 8
+            continue
+        yield start, opcode, ext | arg
+        ext = 0
+        start = offset + 2
+
+
+class OpDecoder(NamedTuple):
+    cls: Type[Opcode]
+    pushes: int = 0
+    resolver: Optional[str] = None
+    pops: Tuple[Union[str, int], ...] = ()
+    special: Optional[Callable[['Parser', int], list]] = None
+
+
+def _decode_store_attr(parser: 'Parser', arg: int):
+    return [(parser.pop(), parser.ctx.load_name(arg)), parser.pop()]
+
+
+def _decode_import_name(parser: 'Parser', arg: int):
+    parser.pop()  # fromlist
+    parser.pop()  # level
+    return [parser.ctx.load_name(arg), []]
+
+
+def _decode_make_function(parser: 'Parser', arg: int):
+    parser.pop()  # Remove load_const
+    code = [parser.pop().arg]
+    if parser.last().op_name == "BUILD_CONST_KEY_MAP":
+        code.insert(0, parser.pop())
+    return code
+
+
+def _decode_build_const_key_map(parser: 'Parser', arg: int):
+    types = [parser.pop(SECOND) for _ in range(arg)]
+    return [parser.pop(), types]
+
+
+def _decode_call_method(parser: 'Parser', arg: int):
+    args = tuple(parser.pop() for _ in range(arg))
+    return [parser.pop(), args]
+
+
+# TODO: Add all opcodes
+
+DECODERS = {decoder.cls.op_byte[0]: decoder for decoder in (
+    OpDecoder(POP_TOP),
+    OpDecoder(BINARY_POWER, 1, pops=(SECOND, TOP)),
+    OpDecoder(BINARY_MULTIPLY, 1, pops=(TOP, TOP)),
+    OpDecoder(BINARY_MODULO, 1, pops=(SECOND, TOP)),
+    OpDecoder(BINARY_ADD, 1, pops=(TOP, TOP)),
+    OpDecoder(BINARY_SUBTRACT, 1, pops=(SECOND, TOP)),
+    OpDecoder(BINARY_SUBSCR, 1, pops=(SECOND, TOP)),
+    OpDecoder(BINARY_FLOOR_DIVIDE, 1, pops=(SECOND, TOP)),
+    OpDecoder(BINARY_TRUE_DIVIDE, 1, pops=(SECOND, TOP)),
+    OpDecoder(GET_ITER, 1, pops=(TOP,)),
+    OpDecoder(BREAK_LOOP),
+    OpDecoder(RETURN_VALUE, pops=(TOP,)),
+    OpDecoder(YIELD_VALUE, 1, pops=(TOP,)),
+    OpDecoder(POP_BLOCK),
+    OpDecoder(STORE_NAME, 0, NAME, (ARG, TOP)),
+    OpDecoder(FOR_ITER, 1, JUMP),
+    OpDecoder(STORE_ATTR, 0, NAME, special=_decode_store_attr),
+    OpDecoder(LOAD_CONST, 1, CONST, (ARG,)),
+    OpDecoder(LOAD_NAME, 1, NAME, (ARG,)),
+    OpDecoder(LOAD_ATTR, 1, NAME, (TOP, ARG)),
+    OpDecoder(COMPARE_OP, 1),
+    OpDecoder(IMPORT_NAME, 1, NAME, special=_decode_import_name),
+    OpDecoder(IMPORT_FROM, 1, NAME, (ARG,)),
+    OpDecoder(JUMP_FORWARD, 0, JUMP),
+    OpDecoder(JUMP_IF_TRUE_OR_POP, 0, JUMP, (TOP,)),
+    OpDecoder(JUMP_ABSOLUTE, 0, JUMP),
+    OpDecoder(POP_JUMP_IF_FALSE, 0, JUMP, (TOP,)),
+    OpDecoder(LOAD_GLOBAL, 1, NAME, (ARG,)),
+    OpDecoder(SETUP_LOOP, 0, JUMP),
+    OpDecoder(LOAD_FAST, 1, FAST, (ARG,)),
+    OpDecoder(STORE_FAST, 0, FAST, (ARG, TOP)),
+    OpDecoder(CALL_FUNCTION, 1, pops=(SECOND, TOP)),
+    OpDecoder(MAKE_FUNCTION, 1, special=_decode_make_function),
+    OpDecoder(BUILD_CONST_KEY_MAP, 1, special=_decode_build_const_key_map),
+    OpDecoder(LOAD_METHOD, 2, NAME, (TOP, ARG)),
+    OpDecoder(CALL_METHOD, 1, special=_decode_call_method),
+)}
 
 
 class Parser:
     def __init__(self, func_or_data):
-        if isinstance(func_or_data, bytes):
-            self.buffer = BytesIO(func_or_data)
+        if isinstance(func_or_data, (bytes, bytearray, memoryview)):
+            self.code = memoryview(func_or_data)
             self.ctx = Context()
+            self.lines = {}
 
         elif isinstance(func_or_data, str):
             code = compile(func_or_data, "<input>", "exec", optimize=0)
-            self.buffer = BytesIO(code.co_code)
+            self.code = memoryview(code.co_code)
             self.ctx = Context(
                 code.co_names,
                 code.co_consts,
                 code.co_varnames
             )
+            self.lines = dict(dis.findlinestarts(code))
 
         else:
             try:
                 code = func_or_data.__code__
             except AttributeError:
                 code = func_or_data
-            self.buffer = BytesIO(code.co_code)
+            self.code = memoryview(code.co_code)
             self.ctx = Context(
                 code.co_names,
                 code.co_consts,
                 code.co_varnames
             )
+            self.lines = dict(dis.findlinestarts(code))
 
+        # The expression stack of the tree parse, operands are popped off it into the ops that use them.
+        # The ops in program order only exist as the flat result of parse_bytecode().
         self.ops: List[Opcode] = []
-        self._ops: List[Opcode] = []
-
-    def unpack(self, fmt: str):
-        size = struct.calcsize(fmt)
-        data = struct.unpack(fmt, self.read(size))
-        return data if len(data) != 1 else data[0]
-
-    def read(self, num=None):
-        return self.buffer.read(num)
-
-    def tell(self):
-        return self.buffer.tell()
-
-    def seek(self, num):
-        self.buffer.seek(num)
-
-    def add_op(self, cls, arg=None):
-        op = cls(*arg)
-        self.ops.append(op)
-        self._ops.append(op)
 
     def pop(self, index: int = None):
         return self.ops.pop(index) if index is not None else self.ops.pop()
@@ -63,189 +162,42 @@ class Parser:
         return NOP()
 
     def parse_bytecode(self, tree=True):
-        from bytepatches import ops as op_data
-        is_op = lambda op: type(op) == type and issubclass(op, Opcode) and op != Opcode
-        ops_cls = [getattr(op_data, y)
-                   for y in dir(op_data)
-                   if is_op(getattr(op_data, y))]
-        ops = {
-            struct.unpack("B", x.op_byte)[0]: x
-            for x in ops_cls
+        started = stats.start()
+        resolvers = {
+            NAME: self.ctx.load_name,
+            CONST: partial(self.ctx.load_const, tree=tree),
+            FAST: self.ctx.load_fast,
         }
-
-        while True:
-            pos = self.tell()
-            if self.read(1):
-                self.seek(pos)
-                opcode, arg = self.unpack("BB")
-                op = ops.get(opcode)
-
-                # TODO: Add all opcodes
-
-                if opcode == 1:
-                    # POP_TOP
-                    self.add_op(op, [arg])
-
-                elif opcode == 19:
-                    # BINARY_POWER
-                    self.add_op(op, [arg, self.pop(-2), self.pop()])
-
-                elif opcode == 20:
-                    # BINARY_MULTIPLY
-                    self.add_op(op, [arg, self.pop(), self.pop()])
-
-                elif opcode == 22:
-                    # BINARY_MODULO
-                    self.add_op(op, [arg, self.pop(-2), self.pop()])
-
-                elif opcode == 23:
-                    # BINARY_ADD
-                    self.add_op(op, [arg, self.pop(), self.pop()])
-
-                elif opcode == 24:
-                    # BINARY_SUBTRACT
-                    self.add_op(op, [arg, self.pop(-2), self.pop()])
-
-                elif opcode == 25:
-                    # BINARY_SUBSCR
-                    self.add_op(op, [arg, self.pop(-2), self.pop()])
-
-                elif opcode == 26:
-                    # BINARY_FLOOR_DIVIDE
-                    self.add_op(op, [arg, self.pop(-2), self.pop()])
-
-                elif opcode == 27:
-                    # BINARY_TRUE_DIVIDE
-                    self.add_op(op, [arg, self.pop(-2), self.pop()])
-
-                elif opcode == 68:
-                    # GET_ITER
-                    self.add_op(op, [arg, self.pop()])
-
-                elif opcode == 80:
-                    # BREAK_LOOP
-                    self.add_op(op, [arg])
-
-                elif opcode == 83:
-                    # RETURN_VALUE
-                    self.add_op(op, [arg, self.pop()])
-
-                elif opcode == 86:
-                    # YIELD_VALUE
-                    self.add_op(op, [arg, self.pop()])
-
-                elif opcode == 87:
-                    # POP_BLOCK
-                    self.add_op(op, [arg])
-
-                elif opcode == 90:
-                    # STORE_NAME
-                    self.add_op(op, [arg, self.ctx.load_name(arg), self.pop()])
-
-                elif opcode == 93:
-                    # FOR_ITER
-                    self.add_op(op, [arg])
-
-                elif opcode == 95:
-                    # STORE_ATTR
-                    self.add_op(op, [arg, (self.pop(), self.ctx.load_name(arg)), self.pop()])
-
-                elif opcode == 100:
-                    # LOAD_CONST
-                    self.add_op(op, [arg, self.ctx.load_const(arg)])
-
-                elif opcode == 101:
-                    # LOAD_NAME
-                    self.add_op(op, [arg, self.ctx.load_name(arg)])
-
-                elif opcode == 106:
-                    # LOAD_ATTR
-                    self.add_op(op, [arg, self.pop(), self.ctx.load_name(arg)])
-
-                elif opcode == 107:
-                    # COMPARE_OP
-                    self.add_op(op, [arg])
-
-                elif opcode == 108:
-                    # IMPORT_NAME
-                    imported_names = self.pop()
-                    unknown_val = self.pop()
-                    print(imported_names, unknown_val)
-                    self.add_op(op, [arg, self.ctx.load_name(arg), []])
-
-                elif opcode == 109:
-                    # IMPORT_FROM
-                    self.add_op(op, [arg, self.ctx.load_name(arg)])
-
-                elif opcode == 110:
-                    # JUMP_FORWARD
-                    self.add_op(op, [arg])
-
-                elif opcode == 112:
-                    # JUMP_IF_TRUE_OR_POP
-                    self.add_op(op, [arg, self.pop()])
-
-                elif opcode == 113:
-                    # JUMP_ABSOLUTE
-                    self.add_op(op, [arg])
-
-                elif opcode == 114:
-                    # POP_JUMP_IF_FALSE
-                    self.add_op(op, [arg, self.pop()])
-
-                elif opcode == 116:
-                    # LOAD_GLOBAL
-                    self.add_op(op, [arg, self.ctx.load_name(arg)])
-
-                elif opcode == 120:
-                    # SETUP_LOOP
-                    self.add_op(op, [arg])
-
-                elif opcode == 124:
-                    # LOAD_FAST
-                    self.add_op(op, [arg, self.ctx.load_fast(arg)])
-
-                elif opcode == 125:
-                    # STORE_FAST
-                    self.add_op(op, [arg, self.ctx.load_fast(arg), self.pop()])
-
-                elif opcode == 131:
-                    # CALL_FUNCTION
-                    self.add_op(op, [arg, self.pop(-2), self.pop()])
-
-                elif opcode == 132:
-                    # MAKE_FUNCTION
-                    self.pop()  # Remove load_const
-                    code = [self.pop().arg]
-                    if self.last().op_name == "BUILD_CONST_KEY_MAP":
-                        code.insert(0, self.pop())
-                    self.add_op(op, [arg, *code])
-
-                elif opcode == 156:
-                    # BUILD_CONST_KEY_MAP
-                    types = [self.pop(-2) for _ in range(arg)]
-                    self.add_op(op, [arg, self.pop(), types])
-
-                elif opcode == 160:
-                    # LOAD_METHOD
-                    self.add_op(op, [arg, self.pop(), self.ctx.load_name(arg)])
-
-                elif opcode == 161:
-                    # CALL_METHOD
-                    args = tuple(self.pop() for _ in range(arg))
-                    self.add_op(op, [arg, self.pop(), args])
-
-                else:
-                    self.seek(self.tell() - 2)
-                    import dis
-                    dis.dis(self.read())
-                    raise Exception(f"Unhandled opcode {opcode} with argument {arg}")
-
-                self.last().set_bytecode_pos(int(pos / 2))
-
+        stack = self.ops
+        flat = []
+        pop = stack.pop
+        lines = self.lines
+        line = None
+
+        for pos, opcode, arg in iter_instructions(self.code):
+            line = lines.get(pos, line)
+            decoder = DECODERS.get(opcode)
+            if decoder is None:
+                raise UnhandledOpcode(f"Unhandled opcode {dis.opname[opcode]} ({opcode}) with argument {arg} "
+                                      f"at offset {pos}")
+
+            if decoder.special is not None:
+                args = decoder.special(self, arg)
             else:
-                break
-
-        sync_ops(self._ops)
-        _p = [self._ops, self.ops][tree]
+                args = []
+                for operand in decoder.pops:
+                    if operand is ARG:
+                        args.append(resolvers[decoder.resolver](arg))
+                    else:
+                        args.append(pop(operand))
+
+            op = decoder.cls(arg, *args)
+            op.set_bytecode_pos(pos)
+            op.lineno = line
+            stack.append(op)
+            flat.append(op)
+
+        sync_ops(flat)
+        stats.stop(started, "parse", len(flat))
+        _p = [flat, stack][tree]
         return _p if len(_p) != 1 else _p[0]
@@ -0,0 +1,188 @@
+import hashlib
+from functools import partial
+from types import CodeType, FunctionType, ModuleType
+from typing import Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+from bytepatches import cache, stats
+from bytepatches.assembler import assemble
+from bytepatches.matcher import PatternSet
+from bytepatches.op_replacer import OpNotFound, compile_pattern, bind_pattern, code_tables, \
+    optimize_access
+from bytepatches.ops import Opcode, POP_TOP, RETURN_VALUE, LOAD_CONST, JUMP_FORWARD, LOAD_FAST, STORE_FAST, \
+    POP_BLOCK, JUMP_ABSOLUTE
+from bytepatches.optimizer import propagate_copies, fold_constants, eliminate_dead_code, thread_jumps, \
+    hoist_invariants
+from bytepatches.parser import Parser, UnhandledOpcode, CONST, FAST
+from bytepatches.utils import InternTable
+
+Tables = Dict[str, InternTable]
+Rule = Callable[[List[Opcode], Tables], int]
+
+OMIT_RETURN_NAME = "omitReturnVariableName"
+
+
+def _replace_rule(before_code: Union[str, List[Opcode]], after_code: Union[str, List[Opcode]], name_to_fast: bool,
+                  ops: List[Opcode], tables: Tables) -> int:
+    # Compiled on first use, so cached functions never parse the patterns
+    before, after = compile_pattern(before_code, after_code, name_to_fast)
+    # Bound into copies, so functions the pattern doesn't match don't gain its constants
+    scratch = {resolver: table.copy() for resolver, table in tables.items()}
+    matches = PatternSet([bind_pattern(scratch, before, after, name_to_fast)]).apply(ops)
+    if matches:
+        tables.update(scratch)
+    return matches
+
+
+def _omit_return_rule(ops: List[Opcode], tables: Tables) -> int:
+    index = tables[FAST].add(OMIT_RETURN_NAME)
+    return PatternSet([
+        # Regular
+        ([POP_TOP(0), LOAD_CONST(0), RETURN_VALUE(0)],
+         [RETURN_VALUE(0)]),
+
+        # If/elif/else
+        ([POP_TOP(0), JUMP_FORWARD("$1")],
+         [JUMP_FORWARD("$1")]),
+
+        # For loop
+        ([POP_BLOCK(0), LOAD_CONST(0), RETURN_VALUE(0)],
+         [POP_BLOCK(0), LOAD_FAST(index, OMIT_RETURN_NAME), RETURN_VALUE(0)]),
+
+        ([POP_TOP(0), JUMP_ABSOLUTE("$1")],
+         [STORE_FAST(index, OMIT_RETURN_NAME), JUMP_ABSOLUTE("$1")]),
+    ]).apply(ops)
+
+
+def _optimize_rule(ops: List[Opcode], tables: Tables) -> int:
+    return sum(propagate_copies(ops))
+
+
+def _fold_constants_rule(ops: List[Opcode], tables: Tables) -> int:
+    return fold_constants(ops, tables[CONST])
+
+
+def _eliminate_dead_code_rule(ops: List[Opcode], tables: Tables) -> int:
+    return sum(eliminate_dead_code(ops))
+
+
+def _thread_jumps_rule(ops: List[Opcode], tables: Tables) -> int:
+    return thread_jumps(ops)
+
+
+def _hoist_invariants_rule(attributes: Tuple[str, ...], ops: List[Opcode], tables: Tables) -> int:
+    return hoist_invariants(ops, tables[FAST], attributes)
+
+
+class PatchSet:
+    # Rules applied in the order they were added, all within a single parse and assemble per function.
+    # Can be used as a decorator on functions and classes, or applied to a module.
+
+    def __init__(self):
+        self.rules: List[Tuple[Rule, bool, Optional[Hashable]]] = []  # (rule, whether it has to match, key)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __call__(self, target):
+        return self.apply(target)
+
+    def add(self, rule: Rule, required: bool = False, key: Hashable = None) -> 'PatchSet':
+        # `key` identifies what the rule does across processes, rules without one are never cached
+        self.rules.append((rule, required, key))
+        return self
+
+    @property
+    def fingerprint(self) -> Optional[str]:
+        keys = [key for _, _, key in self.rules]
+        if None in keys:
+            return None
+        return hashlib.sha256(repr((cache.sources_digest(), keys)).encode()).hexdigest()
+
+    def replace(self, before_code: Union[str, List[Opcode]], after_code: Union[str, List[Opcode]],
+                name_to_fast=True) -> 'PatchSet':
+        key = None
+        if isinstance(before_code, str) and isinstance(after_code, str):
+            key = ("replace", before_code, after_code, name_to_fast)
+        return self.add(partial(_replace_rule, before_code, after_code, name_to_fast), True, key)
+
+    def omit_return(self) -> 'PatchSet':
+        return self.add(_omit_return_rule, key=("omit_return",))
+
+    def optimize(self) -> 'PatchSet':
+        return self.add(_optimize_rule, key=("optimize",))
+
+    def fold_constants(self) -> 'PatchSet':
+        return self.add(_fold_constants_rule, key=("fold_constants",))
+
+    def eliminate_dead_code(self) -> 'PatchSet':
+        return self.add(_eliminate_dead_code_rule, key=("eliminate_dead_code",))
+
+    def thread_jumps(self) -> 'PatchSet':
+        return self.add(_thread_jumps_rule, key=("thread_jumps",))
+
+    def hoist_invariants(self, *attributes: str) -> 'PatchSet':
+        # Only the given attributes, as "y" or "x.y", are assumed not to change while a loop runs
+        attributes = tuple(sorted(set(attributes)))
+        return self.add(partial(_hoist_invariants_rule, attributes), key=("hoist_invariants", attributes))
+
+    def patch_code(self, code: CodeType, strict: bool = True) -> CodeType:
+        code_cache = cache.get_cache()
+        fingerprint = self.fingerprint if code_cache is not None else None
+        if fingerprint is not None:
+            # Lenient results may have skipped rules a strict patch has to raise for
+            fingerprint += ":strict" if strict else ":lenient"
+            patched = code_cache.get(code, fingerprint)
+            if patched is not None:
+                return patched
+
+        patched = self._patch_code(code, strict)
+        if fingerprint is not None:
+            code_cache.put(code, fingerprint, patched)
+        return patched
+
+    def _patch_code(self, code: CodeType, strict: bool) -> CodeType:
+        previous = stats.set_function(code)
+        try:
+            return self._patch_ops(code, strict)
+        finally:
+            stats.restore_function(previous)
+
+    def _patch_ops(self, code: CodeType, strict: bool) -> CodeType:
+        ops = Parser(code).parse_bytecode(False)
+        tables = code_tables(code)
+        for rule, required, _ in self.rules:
+            if not rule(ops, tables) and required and strict:
+                raise OpNotFound("Ops not found!")
+
+        names, varnames = optimize_access(ops, code)
+        # Tables only grow, so an unchanged size means unchanged consts
+        consts = code.co_consts if len(tables[CONST]) == len(code.co_consts) else tuple(tables[CONST])
+        return assemble(code, ops, consts=consts, names=names, varnames=varnames)
+
+    def apply(self, target, strict: bool = None):
+        # Functions have to match every replace rule, functions found in modules and classes don't
+        if isinstance(target, (staticmethod, classmethod)):
+            self.apply(target.__func__, strict)
+        elif isinstance(target, FunctionType):
+            try:
+                target.__code__ = self.patch_code(target.__code__, strict is not False)
+            except UnhandledOpcode:
+                if strict is not False:
+                    raise
+        elif isinstance(target, (type, ModuleType)):
+            for value in list(vars(target).values()):
+                if self._owns(target, value):
+                    self.apply(value, False)
+        else:
+            raise TypeError(f"Cannot patch {type(target).__name__} objects")
+        return target
+
+    @staticmethod
+    def _owns(target, value) -> bool:
+        # Skips functions and classes that were only imported into a module, or aliased from elsewhere
+        value = getattr(value, "__func__", value)
+        if not isinstance(value, (FunctionType, type)):
+            return False
+        if isinstance(target, ModuleType):
+            return value.__module__ == target.__name__
+        return value.__qualname__.startswith(target.__qualname__ + ".")
@@ -1,5 +1,6 @@
 import datetime
 import marshal
+import mmap
 import struct
 import types
 from io import BytesIO
@@ -8,51 +9,111 @@ from bytepatches import utils
 from bytepatches.ops import pretty_printer
 from bytepatches.parser import Parser
 
+# PEP 552 (3.7+): a flags word after the magic, with a source hash instead of mtime/size for hash-based pycs
+FLAGS_MAGIC = 3392
+FLAG_HASH_BASED = 0b01
+FLAG_CHECK_SOURCE = 0b10
+
 
 class PycParser:
-    def __init__(self, fn):
+    def __init__(self, fn, use_mmap: bool = False):
+        self._file = None
         if isinstance(fn, str):
-            with open(fn, "rb") as f:
-                self.buf = BytesIO(f.read())
+            if use_mmap:
+                self._file = open(fn, "rb")
+                self.buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                with open(fn, "rb") as f:
+                    self.buf = f.read()
         else:
-            self.buf = BytesIO(fn.read())
+            self.buf = fn.read()
 
         self.timestamp = None
         self.version = None
-        self.content = None
+        self.flags = 0
+        self.source_hash = None
+        self.header_size = 0
         self.size = 0
         self.filename = [None, fn][isinstance(fn, str)]
 
-        self.read = self.buf.read
-        self.seek = self.buf.seek
-        self.tell = self.buf.tell
+        self._code = None
+        self._content = None
 
     def __repr__(self):
+        content = "<not parsed>" if self._content is None else self._content
         return (f"{self.filename or 'file.pyc'}(file_size={self.size}, "
-                f"last_edited={self.timestamp}, contents={self.content})")
+                f"last_edited={self.timestamp}, contents={content})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self.buf.close()
+            self._file.close()
+            self._file = None
 
-    def unpack(self, fmt):
-        size = struct.calcsize(fmt)
-        data = self.read(size)
-        res = struct.unpack(fmt, data)
+    def unpack(self, fmt, offset):
+        res = struct.unpack_from(fmt, self.buf, offset)
         return res[0] if len(res) == 1 else res
 
+    @property
+    def hash_based(self) -> bool:
+        return bool(self.flags & FLAG_HASH_BASED)
+
+    @property
+    def check_source(self) -> bool:
+        return bool(self.flags & FLAG_CHECK_SOURCE)
+
     def parse(self):
-        self.parse_file()
-        self.parse_body()
+        # The code and its ops are only decoded once `code`/`content` are accessed
+        self.parse_header()
+
+    def parse_header(self):
+        self.version = self.unpack("<H", 0)
+        assert self.buf[2:4] == b"\r\n"  # CRLF
+        if self.version >= FLAGS_MAGIC:
+            self.flags = self.unpack("<I", 4)
+            self.header_size = 16
+            offset = 8
+        else:
+            self.flags = 0
+            self.header_size = 12
+            offset = 4
+
+        if self.hash_based:
+            self.source_hash = bytes(self.buf[8:16])
+            self.timestamp = None
+            self.size = None
+        else:
+            timestamp, self.size = self.unpack("<II", offset)
+            self.timestamp = datetime.datetime.fromtimestamp(timestamp)
 
     def parse_file(self):
-        self.version = self.unpack("H")
-        assert self.read(2) == b"\r\n"  # CRLF
-        self.read(4)  # NULL
-        timestamp, self.size = self.unpack("ii")
-        self.timestamp = datetime.datetime.fromtimestamp(timestamp)
-        self.seek(16)
-        self.content = marshal.loads(self.read())
+        self.parse_header()
+        return self.code
 
     def parse_body(self):
-        # TODO
-        self.content = Parser(self.content).parse_bytecode(True)
+        return self.content
+
+    @property
+    def code(self) -> types.CodeType:
+        if self._code is None:
+            if not self.header_size:
+                self.parse_header()
+            # Unmarshals straight from the buffer; the views are released so an mmap can still be closed
+            with memoryview(self.buf) as view, view[self.header_size:] as payload:
+                self._code = marshal.loads(payload)
+        return self._code
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = Parser(self.code).parse_bytecode(True)
+        return self._content
 
 
 if __name__ == "__main__":
@@ -67,4 +128,3 @@ if __name__ == "__main__":
     parser = PycParser("__pycache__/utils.cpython-37.pyc")
     parser.parse()
     print(parser)
-
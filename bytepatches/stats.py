@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+from time import perf_counter
+from types import CodeType
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Off by default. Instrumented code only calls start()/stop(), which return right away while disabled.
+# Stage times are inclusive, e.g. "match" contains the "sync" it triggers.
+
+enabled = False
+
+
+class Event(NamedTuple):
+    stage: str
+    function: Optional[str]
+    elapsed: float
+    ops: int
+    matches: int
+
+
+class StageStats:
+    __slots__ = ("calls", "time", "ops", "matches")
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.ops = 0
+        self.matches = 0
+
+    def __repr__(self):
+        return f"StageStats(calls={self.calls}, time={self.time:.6f}, ops={self.ops}, matches={self.matches})"
+
+    def add(self, elapsed: float, ops: int, matches: int):
+        self.calls += 1
+        self.time += elapsed
+        self.ops += ops
+        self.matches += matches
+
+
+class Stats:
+    def __init__(self):
+        self.entries: Dict[Tuple[str, Optional[str]], StageStats] = {}
+
+    def __repr__(self):
+        return f"Stats({self.by_stage()})"
+
+    def add(self, event: Event):
+        key = event.stage, event.function
+        if key not in self.entries:
+            self.entries[key] = StageStats()
+        self.entries[key].add(event.elapsed, event.ops, event.matches)
+
+    def _group(self, index: int) -> Dict[Optional[str], StageStats]:
+        result = {}
+        for key, entry in self.entries.items():
+            total = result.setdefault(key[index], StageStats())
+            total.calls += entry.calls
+            total.time += entry.time
+            total.ops += entry.ops
+            total.matches += entry.matches
+        return result
+
+    def by_stage(self) -> Dict[str, StageStats]:
+        return self._group(0)
+
+    def by_function(self) -> Dict[Optional[str], StageStats]:
+        return self._group(1)
+
+    def report(self) -> str:
+        lines = [f"{'stage':<12} {'calls':>8} {'ms':>10} {'ops':>10} {'matches':>8}"]
+        for stage, entry in sorted(self.by_stage().items(), key=lambda item: -item[1].time):
+            lines.append(f"{stage:<12} {entry.calls:>8} {entry.time * 1000:>10.3f} {entry.ops:>10} {entry.matches:>8}")
+        return "\n".join(lines)
+
+    def clear(self):
+        self.entries.clear()
+
+
+stats = Stats()
+hooks: List[Callable[[Event], None]] = []
+_collecting = False
+_collectors: List[Stats] = []
+_function: Optional[str] = None
+
+
+def _refresh():
+    global enabled
+    enabled = _collecting or bool(_collectors) or bool(hooks)
+
+
+def enable():
+    global _collecting
+    _collecting = True
+    _refresh()
+
+
+def disable():
+    global _collecting
+    _collecting = False
+    _refresh()
+
+
+def get_stats() -> Stats:
+    return stats
+
+
+def reset():
+    stats.clear()
+
+
+def add_hook(hook: Callable[[Event], None]):
+    # Called with every Event as it is recorded
+    hooks.append(hook)
+    _refresh()
+
+
+def remove_hook(hook: Callable[[Event], None]):
+    hooks.remove(hook)
+    _refresh()
+
+
+@contextmanager
+def collect():
+    # Records everything in the block into a fresh Stats, whether or not global stats are enabled
+    collector = Stats()
+    _collectors.append(collector)
+    _refresh()
+    try:
+        yield collector
+    finally:
+        _collectors.remove(collector)
+        _refresh()
+
+
+def function_name(code: CodeType) -> str:
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+def set_function(code: Optional[CodeType]) -> Optional[str]:
+    # Attributes the following events to `code`, returns the previous function to restore afterwards
+    global _function
+    previous = _function
+    _function = function_name(code) if enabled and code is not None else None
+    return previous
+
+
+def restore_function(previous: Optional[str]):
+    global _function
+    _function = previous
+
+
+def start() -> Optional[float]:
+    return perf_counter() if enabled else None
+
+
+def stop(started: Optional[float], stage: str, ops: int = 0, matches: int = 0):
+    if started is None:
+        return
+    event = Event(stage, _function, perf_counter() - started, ops, matches)
+    if _collecting:
+        stats.add(event)
+    for collector in _collectors:
+        collector.add(event)
+    for hook in hooks:
+        hook(event)
@@ -0,0 +1,202 @@
+import dis
+from array import array
+from itertools import zip_longest
+from typing import List
+
+from bytepatches.ops import Context, Opcode, JumpOp, b, ext_count, EXTENDED_ARG
+from bytepatches.parser import DECODERS, NAME, CONST, FAST, UnhandledOpcode, iter_instructions
+
+JREL = frozenset(dis.hasjrel)
+JUMPS = JREL | frozenset(dis.hasjabs)
+
+
+class InstructionStream:
+    # Struct-of-arrays view of a function's instructions.
+    # For jumps, the arg column holds the index of the target instruction instead of an offset,
+    # so edits never have to touch the jumps that point past them.
+
+    def __init__(self, opcodes=(), args=(), ctx: Context = None):
+        self.opcodes = array("B", opcodes)
+        self.args = array("L", args)
+        self.positions = array("L")
+        self.ctx = ctx or Context()
+        self.sync()
+
+    @classmethod
+    def from_code(cls, func_or_code):
+        code = getattr(func_or_code, "__code__", func_or_code)
+        offsets = {}
+        opcodes = array("B")
+        args = array("L")
+        for index, (pos, opcode, arg) in enumerate(iter_instructions(code.co_code)):
+            offsets[pos] = index
+            opcodes.append(opcode)
+            if opcode in JREL:
+                arg += pos + 2 * (ext_count(arg) + 1)
+            args.append(arg)
+
+        for index, opcode in enumerate(opcodes):
+            if opcode in JUMPS:
+                args[index] = offsets[args[index]]
+
+        return cls(opcodes, args, Context(code.co_names, code.co_consts, code.co_varnames))
+
+    @classmethod
+    def from_ops(cls, ops: List[Opcode], ctx: Context = None):
+        ops = [op for op in ops if op is not None]
+        indices = {id(op): index for index, op in enumerate(ops)}
+        return cls(
+            (op.op_byte[0] for op in ops),
+            (indices[id(op.val)] if isinstance(op, JumpOp) else op._arg for op in ops),
+            ctx
+        )
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __getitem__(self, index: int) -> Opcode:
+        if index < 0:
+            index += len(self)
+        op = self._make_op(index)
+        op.set_bytecode_pos(self.positions[index])
+        return op
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return f"InstructionStream({len(self)} instructions, {self.positions[-1]} bytes)"
+
+    def is_jump(self, index: int) -> bool:
+        return self.opcodes[index] in JUMPS
+
+    def encoded_arg(self, index: int, size: int = None) -> int:
+        # The argument as it will be written, with jump targets turned back into offsets
+        opcode = self.opcodes[index]
+        arg = self.args[index]
+        if opcode not in JUMPS:
+            return arg
+        target = self.positions[arg]
+        if opcode in JREL:
+            if size is None:
+                size = self.positions[index + 1] - self.positions[index]
+            return target - self.positions[index] - size
+        return target
+
+    def sync(self):
+        sizes = [2 * (ext_count(arg) + 1) if opcode not in JUMPS else 2
+                 for opcode, arg in zip(self.opcodes, self.args)]
+        jumps = [index for index, opcode in enumerate(self.opcodes) if opcode in JUMPS]
+
+        changed = True
+        while changed:
+            # One extra entry holding the total size, so every instruction's size is known
+            self.positions = array("L", [0]) * (len(sizes) + 1)
+            pos = 0
+            for index, size in enumerate(sizes):
+                self.positions[index] = pos
+                pos += size
+            self.positions[-1] = pos
+
+            changed = False
+            for index in jumps:
+                size = 2 * (ext_count(self.encoded_arg(index, sizes[index])) + 1)
+                if size != sizes[index]:
+                    sizes[index] = size
+                    changed = True
+
+    def pack(self) -> bytes:
+        self.sync()
+        extended_arg = EXTENDED_ARG.op_byte
+        payload = bytearray()
+        for index, opcode in enumerate(self.opcodes):
+            arg = self.encoded_arg(index)
+            for shift in range(8 * ext_count(arg), 0, -8):
+                payload += extended_arg + b((arg >> shift) & 0xFF)
+            payload.append(opcode)
+            payload.append(arg & 0xFF)
+        return bytes(payload)
+
+    def _make_op(self, index: int) -> Opcode:
+        opcode = self.opcodes[index]
+        decoder = DECODERS.get(opcode)
+        if decoder is None:
+            raise UnhandledOpcode(f"Unhandled opcode {opcode} with argument {self.args[index]}")
+
+        arg = self.args[index]
+        if decoder.resolver == NAME:
+            return decoder.cls(arg, self.ctx.load_name(arg))
+        elif decoder.resolver == FAST:
+            return decoder.cls(arg, self.ctx.load_fast(arg))
+        elif decoder.resolver == CONST:
+            return decoder.cls(arg, self.ctx.load_const(arg, False))
+        elif opcode in JUMPS:
+            return decoder.cls(self.encoded_arg(index))
+        return decoder.cls(arg)
+
+    def to_ops(self) -> List[Opcode]:
+        ops = list(self)
+        for index, op in enumerate(ops):
+            if isinstance(op, JumpOp):
+                op.val = ops[self.args[index]]
+                op.update()
+        return ops
+
+    def change(self, ops_before: List[Opcode], ops_after: List[Opcode]) -> int:
+        from bytepatches.matcher import PatternSet
+        return self.apply(PatternSet([(ops_before, ops_after)]))
+
+    def apply(self, patterns: 'PatternSet') -> int:
+        matches = patterns.select(patterns.scan(self.opcodes, self.encoded_arg))
+        if not matches:
+            return 0
+
+        opcodes = array("B")
+        args = array("L")
+        remap = array("L", [0]) * len(self)
+
+        def copy(start, stop):
+            for index in range(start, stop):
+                remap[index] = len(opcodes)
+                opcodes.append(self.opcodes[index])
+                args.append(self.args[index])
+
+        done = 0
+        for match in matches:
+            copy(done, match.start)
+            ops_before, ops_after = patterns.patterns[match.pattern]
+            captures = {}
+            for index, op in enumerate(ops_before, match.start):
+                if isinstance(op._arg, str):
+                    captures.setdefault(op._arg, []).append(self.args[index])
+
+            for index, (before, after) in enumerate(zip_longest(ops_before, ops_after), match.start):
+                if after is None:
+                    # Removed, jumps here continue at whatever follows
+                    remap[index] = len(opcodes)
+                    continue
+
+                if isinstance(after._arg, str):
+                    arg = captures[after._arg].pop(0)
+                elif isinstance(after, JumpOp):
+                    raise ValueError(f"{after.op_name} in a replacement must capture its target")
+                else:
+                    arg = after._arg
+
+                if before is not None:
+                    remap[index] = len(opcodes)
+                opcodes.append(after.op_byte[0])
+                args.append(arg)
+            done = match.end
+        copy(done, len(self))
+
+        last = len(opcodes) - 1
+        for index, opcode in enumerate(opcodes):
+            if opcode in JUMPS:
+                args[index] = min(remap[args[index]], last)
+
+        self.opcodes = opcodes
+        self.args = args
+        self.sync()
+        return len(matches)
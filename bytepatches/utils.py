@@ -1,40 +1,158 @@
 import sys
-import matplotlib.pyplot
-from matplotlib.pyplot import plot, legend
+from collections import OrderedDict
 from types import CodeType
-from typing import List
+from typing import Any, Callable, Hashable, Iterable, List, Union
 
-from bytepatches.ops import Opcode
+from bytepatches import stats
+from bytepatches.ops import Opcode, layout_ops
 from bytepatches.parser import Parser
+from bytepatches.stream import InstructionStream
 
 
-def make_bytecode(ops: List[Opcode]):
-    return b"".join(
-        op.pack() for op in ops
-    )
+class LRUCache:
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"LRUCache(hits={self.hits}, misses={self.misses}, maxsize={self.maxsize}, currsize={len(self)})"
+
+    def get(self, key: Hashable, factory: Callable[[], Any]):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            value = self._data[key] = factory()
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class InternTable:
+    # A co_consts/co_names/co_varnames table with O(1) lookup of an item's slot
+    def __init__(self, items: Iterable = (), key: Callable[[Any], Hashable] = None):
+        self.key = key
+        self.items = []
+        self.slots = {}
+        for item in items:
+            self.add(item, True)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self, item):
+        return self._key(item) in self.slots
+
+    def _key(self, item):
+        return self.key(item) if self.key else item
+
+    def add(self, item, duplicate: bool = False) -> int:
+        # Existing tables may hold duplicates, their slots are kept as-is
+        key = self._key(item)
+        if key in self.slots and not duplicate:
+            return self.slots[key]
+        self.slots.setdefault(key, len(self.items))
+        self.items.append(item)
+        return len(self.items) - 1
+
+    def index(self, item) -> int:
+        return self.slots[self._key(item)]
+
+    def copy(self) -> 'InternTable':
+        table = InternTable(key=self.key)
+        table.items = list(self.items)
+        table.slots = dict(self.slots)
+        return table
+
+
+def const_key(const):
+    # Like the compiler, keep 1, 1.0 and True apart, as well as 0.0 and -0.0, also inside tuples
+    if isinstance(const, tuple):
+        return type(const), tuple(const_key(item) for item in const)
+    if isinstance(const, (float, complex)):
+        return type(const), const, repr(const)
+    try:
+        hash(const)
+    except TypeError:
+        # Unhashable values, e.g. dicts put in by bind_globals, are only the same constant as themselves
+        return type(const), id(const)
+    return type(const), const
+
+
+def make_bytecode(ops: Union[List[Opcode], InstructionStream]):
+    started = stats.start()
+    if isinstance(ops, InstructionStream):
+        payload = ops.pack()
+    else:
+        layout_ops(ops)
+        payload = b"".join(
+            op.pack() for op in ops
+        )
+    stats.stop(started, "assemble", len(ops))
+    return payload
 
 
 def get_ops(code: str, tree: bool = False):
     return Parser(code).parse_bytecode(tree)
 
 
-def patch_function(func, payload: bytes, consts=None, names=None, varnames=None):
-    fn_code = func.__code__
-    vars = varnames or fn_code.co_varnames
-    func.__code__ = CodeType(
+def build_code(fn_code: CodeType, payload: bytes, consts=None, names=None, varnames=None, stacksize: int = None,
+               lnotab: bytes = None) -> CodeType:
+    started = stats.start()
+    code = _build_code(fn_code, payload, consts, names, varnames, stacksize, lnotab)
+    stats.stop(started, "code", len(payload) // 2)
+    return code
+
+
+def _build_code(fn_code: CodeType, payload: bytes, consts=None, names=None, varnames=None, stacksize: int = None,
+                lnotab: bytes = None) -> CodeType:
+    # None keeps the original table, an empty tuple empties it
+    consts = fn_code.co_consts if consts is None else consts
+    names = fn_code.co_names if names is None else names
+    vars = fn_code.co_varnames if varnames is None else varnames
+    stacksize = fn_code.co_stacksize if stacksize is None else stacksize
+    lnotab = fn_code.co_lnotab if lnotab is None else lnotab
+    if (payload == fn_code.co_code and vars is fn_code.co_varnames and
+            consts is fn_code.co_consts and names is fn_code.co_names and
+            stacksize == fn_code.co_stacksize and lnotab == fn_code.co_lnotab):
+        # Nothing changed, keep the existing code object
+        return fn_code
+    return CodeType(
         fn_code.co_argcount,
         fn_code.co_kwonlyargcount,
         len(vars),
-        fn_code.co_stacksize,
+        stacksize,
         fn_code.co_flags,
         payload,
-        consts or fn_code.co_consts,
-        names or fn_code.co_names,
+        consts,
+        names,
         vars,
         fn_code.co_filename,
         fn_code.co_name,
         fn_code.co_firstlineno,
-        fn_code.co_lnotab,
+        lnotab,
         fn_code.co_freevars,
         fn_code.co_cellvars
     )
+
+
+def patch_function(func, payload: bytes, consts=None, names=None, varnames=None):
+    code = build_code(func.__code__, payload, consts, names, varnames)
+    if code is not func.__code__:
+        func.__code__ = code
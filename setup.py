@@ -1,5 +1,7 @@
 from setuptools import setup, find_packages
 
+from bytepatches import __version__
+
 if __name__ == '__main__':
     setup(
         name="bytepatches",
@@ -7,7 +9,7 @@ if __name__ == '__main__':
         author_email="mail@martmists.com",
         license="MIT",
         zip_safe=False,
-        version="0.0.1",
+        version=__version__,
         description="A high-level bytecode parser and modifier",
         long_description="TODO",
         url="https://github.com/martmists/bytepatches",
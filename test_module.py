@@ -1,4 +1,9 @@
-from bytepatches.decorators import omit_return, replace, optimize
+from bytepatches.decorators import omit_return, replace, optimize, fold_constants, eliminate_dead_code, \
+    thread_jumps, bind_globals, rebind_globals, hoist_invariants
+from bytepatches import cache, optimizer
+from bytepatches.ops import sync_ops
+from bytepatches.parser import Parser, UnhandledOpcode
+from bytepatches.patchset import PatchSet
 
 if __name__ == "__main__":
     @replace("p=1", "p=3")
@@ -13,6 +18,51 @@ if __name__ == "__main__":
     assert f() == -1
 
 
+    # Both rules in a single pass
+    patches = PatchSet().replace("p=1", "p=3").replace("p-3", "p-4")
+
+
+    @patches
+    def g():
+        p = 1
+        return p - 3
+
+
+    assert g() == -1
+
+
+    # Every method of a class, skipping the ones that don't match
+    @replace("p-3", "p-4")
+    class Patched:
+        def method(self):
+            p = 1
+            return p - 3
+
+        @staticmethod
+        def static():
+            p = 2
+            return p - 3
+
+        def unmatched(self):
+            return 1
+
+
+    assert Patched().method() == -3
+    assert Patched.static() == -2
+    assert Patched().unmatched() == 1
+
+
+    # Code without a match is left as it was
+    class Unmatched:
+        def method(self):
+            return 1
+
+
+    unmatched_code = Unmatched.method.__code__
+    replace("p-3", "p-4")(Unmatched)
+    assert Unmatched.method.__code__ is unmatched_code
+
+
     @omit_return
     def add(a, b):
         a + b
@@ -85,3 +135,494 @@ if __name__ == "__main__":
 
 
     assert juanita_test.__code__.co_code == juanita_optimized.__code__.co_code
+
+
+    # Constants left behind by a replacement get folded once the variable is gone
+    @fold_constants
+    @optimize
+    @replace("p=1", "p=2")
+    def folded():
+        p = 1
+        return p ** 10 - 24
+
+
+    assert folded() == 1000
+    assert len(folded.__code__.co_code) == 4  # LOAD_CONST 1000, RETURN_VALUE
+
+    # The same, with replace, optimize and fold run by one PatchSet
+    def folded_once():
+        x = 1
+        return x - 3
+
+
+    folded_once.__code__ = PatchSet().replace("x = 1", "x = 10").optimize().fold_constants().patch_code(
+        folded_once.__code__)
+    assert folded_once() == 7
+    assert len(folded_once.__code__.co_code) == 4  # LOAD_CONST 7, RETURN_VALUE
+
+
+    # The branch that can no longer be taken is removed along with the check
+    @eliminate_dead_code
+    @optimize
+    @replace("debug=0", "debug=1")
+    def dead_branch():
+        debug = 0
+        if debug:
+            return 1
+        return 2
+
+
+    assert dead_branch() == 1
+    assert len(dead_branch.__code__.co_code) == 4  # LOAD_CONST 1, RETURN_VALUE
+
+
+    # An unreachable last block that only jumps to itself is removed as well
+    def endless_tail():
+        return 1
+        while True:
+            pass
+
+
+    tail_ops = Parser(endless_tail).parse_bytecode(False)[:3]  # LOAD_CONST 1, RETURN_VALUE, JUMP_ABSOLUTE to itself
+    sync_ops(tail_ops)
+    assert optimizer.eliminate_dead_code(tail_ops) == (1, 0)
+
+
+    # The jump omit_return leaves before the final return becomes a return itself
+    @thread_jumps
+    @omit_return
+    def threaded(cond, if_true, if_false):
+        if cond:
+            if_true
+        else:
+            if_false
+
+
+    assert threaded(True, 1, 2) == 1
+    assert threaded(False, 1, 2) == 2
+    assert threaded.__code__.co_code[::2].count(83) == 2  # RETURN_VALUE
+    assert 110 not in threaded.__code__.co_code[::2]  # JUMP_FORWARD
+
+
+    # Globals are looked up once, and again only when asked to
+    scale = 2
+
+
+    @bind_globals(exclude=["abs"])
+    def scaled(x):
+        return abs(x) * scale
+
+
+    scale = 3
+    assert scaled(-2) == 4
+    assert scaled.__code__.co_names == ("abs",)
+    rebind_globals(scaled, "scale")
+    assert scaled(-2) == 6
+
+    # Unhashable globals can be bound under later patches too
+    config = {"offset": 1}
+    items = [1, 2]
+
+
+    @fold_constants
+    @optimize
+    @bind_globals
+    def configured(x):
+        return config["offset"] + len(items) + x
+
+
+    items.append(3)
+    assert configured(1) == 5 and config in configured.__code__.co_consts
+
+
+    # Bound code holds objects marshal can't store, so the cache skips it instead of failing
+    import tempfile
+
+    cache_dir = tempfile.TemporaryDirectory()
+    cache.enable_cache(cache_dir.name)
+
+
+    @optimize
+    @bind_globals
+    def bound_cached(x):
+        y = abs(x)
+        return y
+
+
+    assert bound_cached(-2) == 2
+    assert cache.get_cache().entries() == []
+
+
+    # Stacked patches hit the cache in a fresh process, also for code the first stage loaded from it
+    import subprocess
+    import sys
+
+    script = """if True:
+        from bytepatches import cache
+        from bytepatches.decorators import optimize, replace
+        code_cache = cache.enable_cache(%r)
+
+        @optimize
+        @replace("p=1", "p=2")
+        def cached():
+            p = 1
+            q = p
+            return q
+
+        assert cached() == 2
+        print(code_cache.hits, code_cache.misses)
+    """ % cache_dir.name
+    runs = [subprocess.run([sys.executable, "-c", script], stdout=subprocess.PIPE, check=True).stdout.split()
+            for _ in range(3)]
+    assert runs == [[b"0", b"2"], [b"2", b"0"], [b"2", b"0"]]
+
+    # Corrupt entries are a miss and get deleted
+    import os
+
+    code_cache = cache.get_cache()
+    code_cache.put(g.__code__, "corrupt", g.__code__)
+    entry = code_cache.path(code_cache.key(g.__code__, "corrupt"))
+    with open(entry, "wb") as file:
+        file.write(b"not marshal")
+    assert code_cache.get(g.__code__, "corrupt") is None
+    assert not os.path.exists(entry)
+
+    # The least recently used entries are evicted once the cache outgrows its limit
+    code_cache.clear()
+    for age, name in enumerate(("first", "second", "third")):
+        code_cache.put(f.__code__, name, f.__code__)
+        os.utime(code_cache.path(code_cache.key(f.__code__, name)), (1000 + age, 1000 + age))
+    entry_size = code_cache.entries()[0][1]
+    code_cache.max_size = entry_size * 2
+    code_cache.evict()
+    assert [path for _, _, path in code_cache.entries()] == [code_cache.path(code_cache.key(f.__code__, "third"))]
+    cache.disable_cache()
+    cache_dir.cleanup()
+
+    # A change to bytepatches itself gives every patch set a new fingerprint, for the cache and the import hook
+    from bytepatches.importer import PatchingLoader
+
+    fingerprinted = PatchSet().optimize()
+    fingerprint = fingerprinted.fingerprint
+    tag = PatchingLoader("mod", "mod.py", fingerprinted).cache_path("mod.py")
+    sources = cache.sources_digest()
+    cache._sources_digest = "edited"
+    assert fingerprinted.fingerprint != fingerprint
+    assert PatchingLoader("mod", "mod.py", fingerprinted).cache_path("mod.py") != tag
+    cache._sources_digest = sources
+    assert fingerprinted.fingerprint == fingerprint
+
+
+    # Flagged attributes of locals the loop never rebinds are looked up once
+    @hoist_invariants("append")
+    def collect(out, items):
+        for item in items:
+            out.append(item)
+        return out
+
+
+    assert collect(list(), (1, 2)) == [1, 2]
+    assert "out.append" in collect.__code__.co_varnames
+    assert collect.__code__.co_stacksize == 3  # No longer holds the method and self
+    assert collect(None, ()) is None  # Nothing is looked up when the loop never runs
+
+
+    @hoist_invariants("append")
+    def collect_some(out, items):
+        for item in items:
+            if item:
+                out.append(item)
+        return out
+
+
+    assert collect_some(None, (0,)) is None  # Only loads every iteration runs are moved out
+    assert collect_some(list(), (0, 1)) == [1]
+
+
+    # Unsupported code is reported through the exception alone
+    import contextlib
+    import io
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            Parser(lambda: [1]).parse_bytecode(False)
+        except UnhandledOpcode as e:
+            assert str(e) == "Unhandled opcode BUILD_LIST (103) with argument 1 at offset 2"
+        else:
+            raise AssertionError("BUILD_LIST is not handled")
+    assert output.getvalue() == ""
+
+
+    # Patched modules are written with the .pyc header of the running interpreter
+    from bytepatches.importer import pyc_header
+
+    if sys.version_info >= (3, 7):
+        from importlib._bootstrap_external import _code_to_timestamp_pyc
+
+        assert pyc_header(1234.5, 56) == _code_to_timestamp_pyc(f.__code__, 1234, 56)[:16]
+    else:
+        from importlib._bootstrap_external import _code_to_bytecode
+
+        assert pyc_header(1234.5, 56) == _code_to_bytecode(f.__code__, 1234, 56)[:12]
+
+
+    # Names stored by module code stay in the namespace after it runs
+    module_code = PatchSet().optimize().patch_code(compile("a = 1\nb = a\n", "<module>", "exec"))
+    namespace = {}
+    exec(module_code, namespace)
+    assert namespace["a"] == namespace["b"] == 1
+
+
+    # Control flow graphs: dominators, loops and liveness of small functions
+    from bytepatches.cfg import CFG
+    from bytepatches.ops import BREAK_LOOP, FOR_ITER, JUMP_ABSOLUTE, JUMP_FORWARD, LOAD_FAST, POP_TOP, RETURN_VALUE
+
+    def branch(a):
+        if a:
+            b = 1
+        else:
+            b = 2
+        return b
+
+
+    graph = CFG(Parser(branch).parse_bytecode(False))
+    entry, then, otherwise, join = graph.blocks
+    assert entry.successors == [otherwise, then] and join.predecessors == [then, otherwise]
+    assert all(graph.dominators()[block] is entry for block in (then, otherwise, join))
+    assert not graph.dominates(then, join) and not graph.loops()
+    live_in, live_out = graph.liveness()
+    assert live_in[entry] == {"a"} and live_out[entry] == live_in[then] == frozenset() and live_in[join] == {"b"}
+
+    # Replacing ops that keep the edges only redoes liveness
+    dominators = graph.dominators()
+    graph.replace(then, then.ops[-1:])  # Only the JUMP_FORWARD is left, `b` is no longer set on this path
+    assert graph.dominators() is dominators
+    assert graph.liveness()[0][then] == {"b"} and graph.liveness()[0][entry] == {"a", "b"}
+
+    # Dropping the branch leaves `otherwise` unreachable, removing it relinks the join
+    graph.replace(entry, entry.ops[:-1] + [POP_TOP(0)])
+    assert entry.successors == [then] and otherwise not in graph.reachable()
+    assert graph.dominators()[join] is then
+    graph.remove(otherwise)
+    assert graph.blocks == [entry, then, join] and join.predecessors == [then]
+    assert [type(op) for op in graph.linearize()] == [LOAD_FAST, POP_TOP, JUMP_FORWARD, LOAD_FAST, RETURN_VALUE]
+
+
+    def nested(n):
+        total = 0
+        for i in range(n):
+            for j in range(i):
+                if j == 3:
+                    continue
+                if j == 5:
+                    break
+                total = total + j
+        return total
+
+
+    graph = CFG(Parser(nested).parse_bytecode(False))
+    outer, inner = graph.loops()
+    assert inner.parent is outer and outer.children == [inner] and (outer.depth, inner.depth) == (1, 2)
+    assert isinstance(outer.header.first, FOR_ITER) and isinstance(inner.header.first, FOR_ITER)
+    assert inner.blocks < outer.blocks and graph.dominates(outer.header, inner.header)
+    assert all(graph.dominates(loop.header, block) for loop in (outer, inner) for block in loop.blocks)
+
+    # `continue` jumps back to the inner header, `break` leaves the inner loop but not the outer one
+    continued = next(block for block in inner.blocks
+                     if isinstance(block.last, JUMP_ABSOLUTE) and len(block.ops) == 1)
+    broken = next(block for block in graph if isinstance(block.last, BREAK_LOOP))
+    assert continued.successors == [inner.header]
+    assert graph.loop_of(continued) is inner and graph.loop_of(broken) is outer
+    assert broken.successors[0] in outer.blocks and broken.successors[0] not in inner.blocks
+
+    live_in, live_out = graph.liveness()
+    assert live_in[outer.header] == live_in[inner.header] == {"total"} and live_out[broken] == {"total"}
+    assert live_in[graph.entry] == {"n"} and graph.live_after(graph.entry.first) == {"n"}
+
+
+    # One PatternSet finds every pattern in a single scan, leftmost matches win and earlier patterns break ties
+    from bytepatches.matcher import Match, PatternSet
+    from bytepatches.ops import BINARY_SUBTRACT, LOAD_FAST
+    from bytepatches.stream import InstructionStream
+
+    def pair(a, b):
+        return a - b
+
+
+    pair_ops = Parser(pair).parse_bytecode(False)  # LOAD_FAST a, LOAD_FAST b, BINARY_SUBTRACT, RETURN_VALUE
+    patterns = PatternSet([
+        ([LOAD_FAST(1), BINARY_SUBTRACT(0)], []),
+        ([LOAD_FAST(0), LOAD_FAST(1)], []),
+        ([LOAD_FAST(0), LOAD_FAST(1), BINARY_SUBTRACT(0)], []),
+        ([BINARY_SUBTRACT(0), RETURN_VALUE(0)], []),
+    ])
+    assert sorted(patterns.scan((op.op_byte[0] for op in pair_ops), lambda index: pair_ops[index]._arg)) == [
+        Match(0, 2, 1), Match(0, 3, 2), Match(1, 3, 0), Match(2, 4, 3)]
+    assert patterns.find(pair_ops) == [Match(0, 2, 1), Match(2, 4, 3)]
+
+    # `$n` captures are filled in the order they were matched, the same way for op lists and streams
+    swap = PatternSet([([LOAD_FAST("$0"), LOAD_FAST("$1")], [LOAD_FAST("$1"), LOAD_FAST("$0")])])
+    pair_stream = InstructionStream.from_code(pair)
+    assert swap.apply(pair_ops) == swap.apply(pair_stream) == 1
+    assert [op._arg for op in pair_ops[:2]] == list(pair_stream.args[:2]) == [1, 0]
+    assert pair_ops[0].arg == "b" and pair_ops[1].arg == "a"
+
+    try:
+        PatternSet([([LOAD_FAST(0), None], [])])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("None is not a wildcard")
+
+
+    # .pyc headers: 12 bytes before 3.7, 16 bytes with a flags word after, hash-based ones carry no mtime/size
+    import datetime
+    import marshal
+    import struct
+    from bytepatches.pyc_parser import PycParser
+
+    payload = marshal.dumps(pair.__code__)
+    headers = [
+        (struct.pack("<H2sII", 3379, b"\r\n", 1234, 56), 12, 0),
+        (struct.pack("<H2sIII", 3394, b"\r\n", 0, 1234, 56), 16, 0),
+        (struct.pack("<H2sI8s", 3394, b"\r\n", 0b11, b"8 bytes!"), 16, 0b11),
+    ]
+    for header, header_size, flags in headers:
+        with io.BytesIO(header + payload) as pyc:
+            parsed = PycParser(pyc)
+        parsed.parse()
+        assert (parsed.header_size, parsed.flags) == (header_size, flags)
+        if flags:
+            assert parsed.hash_based and parsed.check_source and parsed.source_hash == b"8 bytes!"
+            assert parsed.timestamp is parsed.size is None
+        else:
+            assert not parsed.hash_based and parsed.source_hash is None
+            assert parsed.timestamp == datetime.datetime.fromtimestamp(1234) and parsed.size == 56
+        assert parsed.code.co_code == pair.__code__.co_code
+
+    # A mapped file is unmarshalled in place and can be closed afterwards
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "pair.pyc")
+        with open(path, "wb") as pyc:
+            pyc.write(headers[1][0] + payload)
+        with PycParser(path, use_mmap=True) as parsed:
+            assert parsed.code.co_code == pair.__code__.co_code
+        assert parsed.buf.closed
+
+
+    # Editing the instruction stream packs to the same bytes as editing the parsed ops
+    import types
+    from bytepatches.op_replacer import change_ops
+    from bytepatches.utils import build_code, make_bytecode
+
+    def looped(n):
+        total = 0
+        for i in range(n):
+            i
+            total = total + i
+        return total
+
+
+    unused = ([LOAD_FAST("$0"), POP_TOP(0)], [])
+    looped_ops = Parser(looped).parse_bytecode(False)
+    change_ops(looped_ops, *unused)
+    looped_stream = InstructionStream.from_code(looped)
+    change_ops(looped_stream, *unused)
+    assert len(looped_stream) == len(looped_ops) == len(Parser(looped).parse_bytecode(False)) - 2
+    assert looped_stream.pack() == make_bytecode(looped_ops) != looped.__code__.co_code
+    looped_code = build_code(looped.__code__, looped_stream.pack())
+    assert types.FunctionType(looped_code, globals())(5) == 10
+
+
+    # The LRU cache evicts the entry used least recently
+    from bytepatches.op_replacer import compile_pattern, pattern_cache
+    from bytepatches.utils import InternTable, LRUCache, const_key
+
+    made = []
+    lru = LRUCache(2)
+    for key in "abac":
+        lru.get(key, lambda: made.append(key) or key.upper())
+    assert made == ["a", "b", "c"] and (lru.hits, lru.misses, len(lru)) == (1, 3, 2)
+    assert lru.get("a", lambda: "evicted") == "A" and lru.get("b", lambda: "evicted") == "evicted"
+
+    # Compiling a pattern again is a cache hit that returns the same snippets
+    pattern_cache.clear()
+    snippets = compile_pattern("x = 1", "x = 2")
+    assert compile_pattern("x = 1", "x = 2") is snippets and (pattern_cache.hits, pattern_cache.misses) == (1, 1)
+    assert compile_pattern("x = 1", "x = 2", name_to_fast=True) is not snippets and pattern_cache.misses == 2
+
+    # Constants that compare equal stay apart, so a patch can turn 1 into 1.0
+    consts = InternTable((), const_key)
+    assert len({consts.add(const) for const in (1, 1.0, True, 0.0, -0.0, (1,), (1.0,))}) == 7
+
+    @replace("x = 1", "x = 1.0")
+    def as_float():
+        x = 1
+        return x
+
+
+    assert type(as_float()) is float
+
+
+    # Stats record every stage per function while collecting, and nothing at all while disabled
+    from bytepatches import stats
+
+    def patched():
+        p = 1
+        return p
+
+
+    unpatched = patched.__code__
+    events = []
+    with stats.collect() as collected:
+        stats.add_hook(events.append)
+        replace("p=1", "p=2")(patched)
+        stats.remove_hook(events.append)
+    by_stage = collected.by_stage()
+    assert {"match", "assemble", "code"} <= set(by_stage) and by_stage["match"].matches == 1
+    assert all(entry.calls for entry in by_stage.values()) and by_stage["match"].ops > 0
+    assert stats.function_name(patched.__code__) in collected.by_function()
+    assert len(events) == sum(entry.calls for entry in by_stage.values())
+
+    stats.enable()
+    patched.__code__ = unpatched
+    replace("p=1", "p=2")(patched)
+    stats.disable()
+    assert stats.get_stats().by_stage()["match"].calls == 1
+    stats.reset()
+
+    assert not stats.enabled and stats.start() is None
+    patched.__code__ = unpatched
+    replace("p=1", "p=2")(patched)
+    assert patched() == 2 and not stats.get_stats().entries
+    assert len(events) == sum(entry.calls for entry in by_stage.values())  # The removed hook saw nothing new
+
+
+    # Patches that would leave the value stack short are refused instead of assembled
+    from bytepatches.ops import LOAD_CONST
+
+    def underflow(a):
+        return a + 1 * 7
+
+
+    try:
+        replace([LOAD_FAST("$0"), LOAD_CONST("$1")], [])(underflow)  # Nothing is left for BINARY_ADD to pop
+    except ValueError as e:
+        assert str(e) == "BINARY_ADD at offset 0 pops more values than the stack holds"
+    else:
+        raise AssertionError("Stack underflow was assembled")
+    assert underflow(1) == 8
+
+
+    # Jumps in a replacement have to capture their target, for op lists as well as streams
+    from bytepatches.ops import JUMP_ABSOLUTE
+
+    literal_jump = PatternSet([([LOAD_FAST("$0"), POP_TOP(0)], [JUMP_ABSOLUTE(0)])])
+    for target in (Parser(looped).parse_bytecode(False), InstructionStream.from_code(looped)):
+        try:
+            literal_jump.apply(target)
+        except ValueError as e:
+            assert str(e) == "JUMP_ABSOLUTE in a replacement must capture its target"
+        else:
+            raise AssertionError("Uncaptured jump was resolved")